@@ -0,0 +1,469 @@
+"""
+Copyright 2019 Andrew Rambaut (a.rambaut@ed.ac.uk)
+https://github.com/rambaut/readucks
+
+This module contains benchmarks for the performance of Readucks. It is executed when a user runs
+`readucks-benchmark` (after installation). It generates synthetic barcoded reads (or uses the reads
+given) and times parsing and demuxing them with each combination of the settings requested.
+
+This file is part of Readucks. Readucks is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Readucks is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Readucks. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import csv
+import os
+import random
+import resource
+import tempfile
+import time
+from collections import defaultdict
+from multiprocessing import get_context
+
+from Bio import SeqIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+
+from . import demuxer, profiler
+from .demuxer import read_fragment_length, init_alignment_worker, get_barcode_panel, get_alignment_plan, \
+    score_panel, alignment_counts
+from .misc import bold_underline, MyHelpFormatter, print_table
+from .reader import open_read_file, read_records, get_read_file_type
+from .pipeline import stall_times, default_queue_depth
+from .readucks import get_barcode_list, get_demux_func, create_worker_pool, process_read_file
+from .writer import BinWriter, format_fastq
+from .version import __version__
+
+
+def main():
+    '''
+    Entry point for the Readucks benchmarks.
+    '''
+    args = get_arguments()
+
+    with tempfile.TemporaryDirectory(prefix='readucks-benchmark-') as temp_dir:
+        read_files = args.input_files
+        if not read_files:
+            read_file = os.path.join(temp_dir, 'synthetic.fastq')
+            print(bold_underline('\nGenerating %i synthetic reads' % args.reads), flush=True)
+            print('Barcodes: %s, error rate: %.2f, mean length: %i, unbarcoded: %.2f, seed: %i' %
+                  (args.barcode_set, args.error_rate, args.read_length, args.unbarcoded, args.seed), flush=True)
+            generate_reads(read_file, args.reads, args.barcode_set, args.error_rate, args.read_length,
+                           args.unbarcoded, args.seed)
+            read_files = [read_file]
+
+        if not args.skip_parsing:
+            for read_file in read_files:
+                print(bold_underline('\nParsing: ' + read_file), flush=True)
+                print_timings(benchmark_parsers(read_file, args.repeats))
+
+        if not args.skip_alignment:
+            for read_file in read_files:
+                print(bold_underline('\nScoring read ends: ' + read_file), flush=True)
+                print_alignment_timings(benchmark_alignment(read_file, args.barcode_set, args.scoring_scheme_vals,
+                                                            args.repeats))
+
+        for read_file in read_files:
+            print(bold_underline('\nDemuxing: ' + read_file), flush=True)
+            runs = []
+            for mode in args.modes:
+                for prefilter_top in args.prefilter_top:
+                    for threads in args.threads:
+                        for batch_size in args.batch_sizes:
+                            # each run is in a fresh process so its peak memory can be measured
+                            runs.append(run_in_process(benchmark_demux, read_file, temp_dir, args.barcode_set, mode,
+                                                       not args.require_two_barcodes, args.engine, threads,
+                                                       batch_size, args.scoring_scheme_vals, prefilter_top,
+                                                       args.kmer_size, args.early_exit, args.prune_after,
+                                                       args.prune_below / 100.0, int(args.cache_size * 1024 * 1024),
+                                                       args.queue_depth))
+                            print_demux_timings(runs[-1:], header=len(runs) == 1)
+
+
+def generate_reads(read_file, n_reads, barcode_set, error_rate, read_length, unbarcoded, seed):
+    '''
+    Writes a FASTQ file of random reads, each with the start barcode at its start and the end barcode
+    (if the set has them) at its end, with errors at the given rate. The true barcode is recorded in
+    each read's name (e.g. read_12_NB03) or 'none' for reads without barcodes.
+    '''
+    rng = random.Random(seed)
+    barcodes = get_barcode_list(barcode_set, None, 0)
+    barcode_ids = list(barcodes)
+
+    with open(read_file, 'wt') as out:
+        for index in range(n_reads):
+            length = rng.randint(read_length // 2, read_length * 3 // 2)
+            sequence = random_sequence(rng, length)
+            barcode_id = 'none'
+            if rng.random() >= unbarcoded:
+                barcode_id = rng.choice(barcode_ids)
+                sequence = random_sequence(rng, rng.randint(5, 25)) + barcodes[barcode_id]['start'] + sequence
+                if barcodes[barcode_id]['end']:
+                    sequence += barcodes[barcode_id]['end'] + random_sequence(rng, rng.randint(5, 25))
+            sequence = add_errors(rng, sequence, error_rate)
+            qualities = ''.join(chr(33 + rng.randint(5, 30)) for _ in sequence)
+            out.write(format_fastq('read_%i_%s' % (index, barcode_id), sequence, qualities))
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+def add_errors(rng, sequence, error_rate):
+    '''
+    Adds equal proportions of substitutions, insertions and deletions to a sequence
+    '''
+    bases = []
+    for base in sequence:
+        r = rng.random()
+        if r >= error_rate:
+            bases.append(base)
+        elif r < error_rate / 3:
+            bases.append(rng.choice('ACGT'))
+        elif r < error_rate * 2 / 3:
+            bases.append(base)
+            bases.append(rng.choice('ACGT'))
+    return ''.join(bases)
+
+
+def run_in_process(func, *args):
+    '''
+    Runs a function in a new process (which may itself start worker processes) and returns its result
+    '''
+    context = get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=send_result, args=(sender, func, args))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def send_result(sender, func, args):
+    sender.send(func(*args))
+    sender.close()
+
+
+def benchmark_demux(read_file, temp_dir, barcode_set, mode, single_barcode, engine, threads, batch_size,
+                    scoring_scheme, prefilter_top=0, kmer_size=5, early_exit=False, prune_after=0,
+                    prune_below=0, cache_size=0, queue_depth=default_queue_depth):
+    '''
+    Demuxes a file of reads as readucks does (through process_read_file's pipeline), writing annotation
+    and bin files, and profiles each stage.
+    :return: a dictionary of the settings, the timings (of the stages and the time each stage of the
+    pipeline stalled), the peak memory and the accuracy of the calls
+    '''
+    settings = {
+        'barcode_set': barcode_set,
+        'single_barcode': single_barcode,
+        'threshold': 0.75,
+        'secondary_threshold': 0.65 if not single_barcode and mode != 'porechop' else None,
+        'score_diff': 0.05,
+        'mode': mode,
+        'additional_info': False,
+        'report_alternate_call': False,
+        'scoring_scheme': scoring_scheme,
+        'prefilter_top': prefilter_top,
+        'kmer_size': kmer_size,
+        'early_exit': early_exit and mode == 'porechop',
+        'prune_after': prune_after,
+        'prune_below': prune_below,
+        'cache_size': cache_size,
+        'engine': engine,
+        'queue_depth': queue_depth,
+        'verbosity': 0
+    }
+
+    output_path = tempfile.mkdtemp(dir=temp_dir) + '/'
+    file_type = get_read_file_type(read_file)
+    output = {
+        'path': output_path,
+        'prefix': None,
+        'bin_barcodes': True,
+        'annotate_files': True,
+        'extended_info': False,
+        'summary_info': False,
+        'file_type': file_type,
+        'bin_writer': BinWriter(output_path, None, file_type)
+    }
+
+    profiler.enable()
+    init_alignment_worker(scoring_scheme)
+    barcodes = get_barcode_list(barcode_set, None, 0)
+    plan = get_alignment_plan(single_barcode, mode, settings['additional_info'], settings['report_alternate_call'],
+                              output['extended_info'], settings['verbosity'])
+    demux_func = get_demux_func(barcodes, settings, plan)
+
+    start_time = time.perf_counter()
+    pool = create_worker_pool(engine, threads, scoring_scheme, True, demux_func = demux_func)
+    pool_seconds = time.perf_counter() - start_time
+    chunk_size = max(1, batch_size // (threads * 4))
+
+    barcode_counts = defaultdict(int)
+    try:
+        process_read_file(read_file, output, settings, barcode_counts, 0, pool, batch_size, chunk_size)
+    finally:
+        output['bin_writer'].close()
+        if pool:
+            pool.close()
+            pool.join()
+    seconds = time.perf_counter() - start_time
+
+    # the stages of the pipeline run at the same time so their times add up to more than the total
+    stage_seconds = {stage: seconds for stage, (_, seconds) in profiler.report['stages'].items()}
+    stages = {
+        'pool': pool_seconds,
+        'read': stage_seconds.get('read_parse', 0),
+        'demux': stage_seconds.get('demux_batch', 0),
+        'write': stage_seconds.get('csv_write', 0) + stage_seconds.get('bin_write', 0)
+    }
+
+    n_reads = sum(barcode_counts.values())
+    n_assigned = n_reads - barcode_counts['unassigned']
+    return {
+        'mode': mode,
+        'prefilter_top': prefilter_top,
+        'engine': engine,
+        'threads': threads,
+        'batch_size': batch_size,
+        'reads': n_reads,
+        'seconds': seconds,
+        'stages': stages,
+        'stalls': dict(stall_times),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_worker_rss': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        'aligned': alignment_counts['aligned'],
+        'skipped': alignment_counts['skipped'],
+        'assigned': n_assigned / n_reads if n_reads else 0,
+        'correct': count_correct(output_path) / n_assigned if n_assigned else 0
+    }
+
+
+def count_correct(output_path):
+    '''
+    Counts the reads in the annotation file whose call is the barcode in their name (see generate_reads)
+    '''
+    annotation_filename = [filename for filename in os.listdir(output_path) if filename.endswith('.csv')][0]
+    with open(os.path.join(output_path, annotation_filename), 'rt') as annotation_file:
+        return sum(1 for row in csv.DictReader(annotation_file) if row['name'].endswith('_' + row['barcode']))
+
+
+def print_demux_timings(runs, header=True):
+    table = [['Mode', 'Top', 'Engine', 'Threads', 'Batch', 'Reads', 'Reads/sec', 'Peak RSS MB', 'Worker RSS MB',
+              'Pool s', 'Read s', 'Demux s', 'Write s', 'Stalled R/D/W s', 'Skipped', 'Assigned', 'Correct']]
+    for run in runs:
+        alignments = run['aligned'] + run['skipped']
+        table.append([run['mode'], str(run['prefilter_top']), run['engine'], str(run['threads']),
+                      str(run['batch_size']), str(run['reads']),
+                      '%.0f' % (run['reads'] / run['seconds']), '%.1f' % run['peak_rss'],
+                      '%.1f' % run['peak_worker_rss'], '%.3f' % run['stages'].get('pool', 0),
+                      '%.3f' % run['stages'].get('read', 0), '%.3f' % run['stages'].get('demux', 0),
+                      '%.3f' % run['stages'].get('write', 0),
+                      '%.2f/%.2f/%.2f' % (run['stalls']['read'], run['stalls']['demux'], run['stalls']['write']),
+                      '%.1f%%' % (100 * run['skipped'] / alignments if alignments else 0),
+                      '%.1f%%' % (100 * run['assigned']), '%.1f%%' % (100 * run['correct'])])
+    print_table(table, None, alignments='LRLRRRRRRRRRRRRRR', indent=0, hide_header=not header,
+                fixed_col_widths=[9, 3, 7, 7, 5, 7, 9, 11, 13, 7, 7, 7, 7, 15, 7, 8, 7])
+
+
+def parse_biopython(handle, file_type):
+    '''
+    Parses reads into SeqRecords and slices their ends (as readucks used to)
+    '''
+    for record in SeqIO.parse(handle, file_type):
+        sequence = str(record.seq)
+        yield record.id, sequence[:read_fragment_length], sequence[-read_fragment_length:]
+
+
+def parse_biopython_strings(handle, file_type):
+    '''
+    Parses reads with Biopython's string based parsers and slices their ends
+    '''
+    if file_type == 'fasta':
+        records = ((title, sequence) for title, sequence in SimpleFastaParser(handle))
+    else:
+        records = ((title, sequence) for title, sequence, _ in FastqGeneralIterator(handle))
+    for title, sequence in records:
+        yield title.split(None, 1)[0], sequence[:read_fragment_length], sequence[-read_fragment_length:]
+
+
+def parse_readucks(handle, file_type):
+    return read_records(handle, file_type, read_fragment_length)
+
+
+PARSERS = [
+    ('Bio.SeqIO.parse', parse_biopython),
+    ('Bio string parsers', parse_biopython_strings),
+    ('readucks.reader', parse_readucks)
+]
+
+
+def benchmark_parsers(read_file, repeats=1):
+    '''
+    Times each of the parsers reading all the records in a file (taking the best of the repeats).
+    :return: a list of (name, seconds, number of reads, megabytes) tuples
+    '''
+    file_type = get_read_file_type(read_file)
+    megabytes = os.path.getsize(read_file) / 1e6
+
+    timings = []
+    for name, parser in PARSERS:
+        best = None
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            with open_read_file(read_file) as handle:
+                n_reads = sum(1 for _ in parser(handle, file_type))
+            seconds = time.perf_counter() - start_time
+            best = seconds if best is None else min(best, seconds)
+        timings.append((name, best, n_reads, megabytes))
+
+    return timings
+
+
+def score_each_barcode(query, references):
+    '''
+    Scores a read end against each barcode separately (so its query profile is built every time)
+    '''
+    return [demuxer.get_score(None, query, reference, demuxer.gap_open, demuxer.gap_extend,
+                              demuxer.nuc_matrix)['score'] for reference in references]
+
+
+def score_whole_panel(query, references):
+    return score_panel(query, references, False)
+
+
+SCORERS = [
+    ('get_score per barcode', score_each_barcode),
+    ('score_panel', score_whole_panel)
+]
+
+
+def benchmark_alignment(read_file, barcode_set, scoring_scheme, repeats=1):
+    '''
+    Times each of the ways of scoring both ends of every read against the barcodes (taking the
+    best of the repeats).
+    :return: a list of (name, seconds, number of alignments) tuples
+    '''
+    init_alignment_worker(scoring_scheme)
+    panel = get_barcode_panel(get_barcode_list(barcode_set, None, 0))
+    with open_read_file(read_file) as handle:
+        ends = [read[1:3] for read in read_records(handle, get_read_file_type(read_file), read_fragment_length)]
+    n_alignments = len(ends) * (sum(1 for seq in panel['start'] if seq) + sum(1 for seq in panel['end'] if seq))
+
+    timings = []
+    for name, scorer in SCORERS:
+        best = None
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            for query_start, query_end in ends:
+                scorer(query_start, panel['start'])
+                scorer(query_end, panel['end'])
+            seconds = time.perf_counter() - start_time
+            best = seconds if best is None else min(best, seconds)
+        timings.append((name, best, n_alignments))
+
+    return timings
+
+
+def print_alignment_timings(timings):
+    table = [['Method', 'Alignments', 'Seconds', 'Alignments/sec', 'Speed up']]
+    baseline = timings[0][1]
+    for name, seconds, n_alignments in timings:
+        table.append([name, str(n_alignments), '%.3f' % seconds, '%.0f' % (n_alignments / seconds),
+                      '%.2fx' % (baseline / seconds)])
+    print_table(table, None, alignments='LRRRR', indent=0)
+
+
+def print_timings(timings):
+    table = [['Parser', 'Reads', 'Seconds', 'Reads/sec', 'MB/sec', 'Speed up']]
+    baseline = timings[0][1]
+    for name, seconds, n_reads, megabytes in timings:
+        table.append([name, str(n_reads), '%.3f' % seconds, '%.0f' % (n_reads / seconds),
+                      '%.1f' % (megabytes / seconds), '%.2fx' % (baseline / seconds)])
+    print_table(table, None, alignments='LRRRRR', indent=0)
+
+
+def get_arguments():
+    '''
+    Parse the command line arguments.
+    '''
+    parser = argparse.ArgumentParser(description='Readucks benchmarks: measures the speed of reading reads.',
+                                     formatter_class=MyHelpFormatter, add_help=False)
+
+    main_group = parser.add_argument_group('Main options')
+    main_group.add_argument('-i', '--input', dest='input_files', nargs='+',
+                            help='FASTQ or FASTA files (optionally gzipped) to use instead of synthetic reads')
+    main_group.add_argument('-r', '--repeats', type=int, default=3,
+                            help='The number of times to repeat each parsing and scoring benchmark (the best time is reported)')
+    main_group.add_argument('--skip_parsing', action='store_true',
+                            help='Skip the parsing benchmarks')
+    main_group.add_argument('--skip_alignment', action='store_true',
+                            help='Skip the benchmarks of scoring read ends against the barcodes')
+
+    synthetic_group = parser.add_argument_group('Synthetic reads')
+    synthetic_group.add_argument('--reads', type=int, default=10000,
+                                 help='The number of reads to generate')
+    synthetic_group.add_argument('--barcode_set', default='native', choices=['native', 'pcr', 'rapid'],
+                                 help='The barcodes to add to the reads')
+    synthetic_group.add_argument('--error_rate', type=float, default=0.1,
+                                 help='The rate of substitutions, insertions and deletions in the reads')
+    synthetic_group.add_argument('--read_length', type=int, default=500,
+                                 help='The mean length of the reads')
+    synthetic_group.add_argument('--unbarcoded', type=float, default=0.1,
+                                 help='The proportion of reads without barcodes')
+    synthetic_group.add_argument('--seed', type=int, default=1,
+                                 help='The seed for the random number generator')
+
+    demux_group = parser.add_argument_group('Demuxing settings',
+                                            'Every combination of these settings is benchmarked')
+    demux_group.add_argument('-m', '--modes', nargs='+', default=['porechop', 'stringent', 'lenient'],
+                             choices=['porechop', 'stringent', 'lenient'],
+                             help='The demuxing modes')
+    demux_group.add_argument('-t', '--threads', nargs='+', type=int, default=[1, 2],
+                             help='The numbers of threads')
+    demux_group.add_argument('-n', '--batch_sizes', nargs='+', type=int, default=[200],
+                             help='The numbers of reads in each batch')
+    demux_group.add_argument('--queue_depth', type=int, default=default_queue_depth,
+                             help='The number of batches of reads that can wait between reading, demuxing '
+                                  'and writing')
+    demux_group.add_argument('--engine', default='thread', choices=['thread', 'process'],
+                             help='Run the demuxing workers as threads or as separate processes')
+    demux_group.add_argument('--prefilter_top', nargs='+', type=int, default=[0],
+                             help='The numbers of barcodes (by shared k-mers) to align to each end of a read '
+                                  '(0 for all of them)')
+    demux_group.add_argument('--kmer_size', type=int, default=5,
+                             help='The length of the k-mers used by the prefilter (and the early exit)')
+    demux_group.add_argument('--early_exit', action='store_true',
+                             help='In porechop mode, skip the barcodes that can\'t come close to the best one')
+    demux_group.add_argument('--prune_after', type=int, default=0,
+                             help='Prune the barcodes no read has been called as after this many reads (0 to not prune)')
+    demux_group.add_argument('--prune_below', type=float, default=0,
+                             help='Also prune the barcodes at most this percent of the reads have been called as')
+    demux_group.add_argument('--cache_size', type=float, default=0,
+                             help='The MB of read end fragment scores to cache in each process (0 to not cache)')
+    demux_group.add_argument('--require_two_barcodes', action='store_true',
+                             help='Match barcodes at both ends of read')
+    demux_group.add_argument('--scoring_scheme', type=str, default='3,-6,-5,-2',
+                             help='Comma-delimited string of alignment scores: match, '
+                                  'mismatch, gap open, gap extend')
+
+    help_args = parser.add_argument_group('Help')
+    help_args.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS,
+                           help='Show this help message and exit')
+    help_args.add_argument('--version', action='version', version=__version__,
+                           help="Show program's version number and exit")
+
+    args = parser.parse_args()
+    args.scoring_scheme_vals = [int(x) for x in args.scoring_scheme.split(',')]
+
+    return args
+
+
+if __name__ == '__main__':
+    main()
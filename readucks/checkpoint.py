@@ -0,0 +1,93 @@
+"""
+Copyright 2019 Andrew Rambaut (a.rambaut@ed.ac.uk)
+https://github.com/rambaut/readucks
+
+This module keeps the checkpoint of a run (with --checkpoint) so that it can be resumed (with
+--resume) if it stops before the end. The checkpoint is a small JSON file in the output directory
+that records the input files completed (with their sizes and modification times), the barcodes
+looked for, the number of reads called as each barcode and the length of each bin file. It is only
+written when every input file being processed has been completed, so the bin files are consistent
+with it: when resuming, any reads written after it are cut off the ends of the bin files.
+
+This file is part of Readucks. Readucks is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Readucks is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Readucks. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+import sys
+
+checkpoint_filename = 'readucks_checkpoint.json'
+
+
+def get_checkpoint_path(output_path, prefix):
+    '''
+    Returns the path of the checkpoint in the output directory
+    '''
+    return (output_path if output_path else "") + (prefix if prefix else "") + checkpoint_filename
+
+
+def new_checkpoint(barcodes):
+    return {
+        'files': {},
+        'barcodes': list(barcodes),
+        'barcode_counts': {},
+        'bins': {}
+    }
+
+
+def load_checkpoint(filename):
+    '''
+    Loads a checkpoint (or returns None if there isn't one), checking that the files it records as
+    completed haven't changed since
+    '''
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename, 'rt') as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+
+    for read_file, (size, mtime) in checkpoint['files'].items():
+        if not os.path.exists(read_file):
+            sys.exit('Error: ' + read_file + ', completed before the checkpoint, no longer exists')
+        stat = os.stat(read_file)
+        if stat.st_size != size or stat.st_mtime != mtime:
+            sys.exit('Error: ' + read_file + ' has changed since the checkpoint')
+
+    return checkpoint
+
+
+def save_checkpoint(filename, checkpoint, read_files, barcode_counts, bin_offsets):
+    '''
+    Adds the completed read files, the barcode counts and the bin file lengths to the checkpoint
+    and writes it (replacing the previous one in one step so a checkpoint is never left half written)
+    '''
+    for read_file in read_files:
+        stat = os.stat(read_file)
+        checkpoint['files'][os.path.abspath(read_file)] = [stat.st_size, stat.st_mtime]
+    checkpoint['barcode_counts'] = dict(barcode_counts)
+    checkpoint['bins'] = dict(bin_offsets)
+
+    with open(filename + '.tmp', 'wt') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file, indent=2)
+    os.replace(filename + '.tmp', filename)
+
+
+def truncate_bins(checkpoint):
+    '''
+    Cuts the bin files back to their lengths at the checkpoint (removing the reads binned since)
+    '''
+    for bin_filename, offset in checkpoint['bins'].items():
+        if not os.path.exists(bin_filename) or os.path.getsize(bin_filename) < offset:
+            sys.exit('Error: ' + bin_filename + ' is shorter than it was at the checkpoint')
+        with open(bin_filename, 'r+b') as bin_file:
+            bin_file.truncate(offset)
+
+
+def is_completed(checkpoint, read_file):
+    return os.path.abspath(read_file) in checkpoint['files']
@@ -14,6 +14,11 @@ details. You should have received a copy of the GNU General Public License along
 not, see <http://www.gnu.org/licenses/>.
 """
 
+import sys
+import threading
+from collections import namedtuple, OrderedDict
+
+import numpy as np
 import parasail
 
 from .barcodes import NATIVE_BARCODES, PCR_BARCODES, RAPID_BARCODES
@@ -25,6 +30,70 @@ gap_extend = 1
 
 read_fragment_length = 100
 
+# the alignment of a barcode to one end of a read (the matches and length are None if only its
+# identity was needed and the mismatches and trace are None unless it is to be printed)
+Alignment = namedtuple('Alignment', ['id', 'score', 'identity', 'matches', 'length', 'mismatches', 'trace'])
+
+# the result of demuxing a read: its name, the call (and alternate call) and the best barcodes at the
+# primary and secondary ends (as BarcodeMatches)
+DemuxResult = namedtuple('DemuxResult', ['name', 'call', 'alt_call', 'primary', 'secondary'])
+
+
+class BarcodeMatch(namedtuple('BarcodeMatch', ['is_start', 'start', 'end'])):
+    '''
+    The best barcode at one end of a read (is_start is 1 for the start, 0 for the end) with its
+    Alignments to the start and end of the read (the one to the other end is None unless it was needed).
+    Its id, score, identity, matches and length are those of the alignment at its own end.
+    '''
+    __slots__ = ()
+
+    @property
+    def alignment(self):
+        return self.start if self.is_start else self.end
+
+    @property
+    def id(self):
+        return self.alignment.id
+
+    @property
+    def score(self):
+        return self.alignment.score
+
+    @property
+    def identity(self):
+        return self.alignment.identity
+
+    @property
+    def matches(self):
+        return self.alignment.matches
+
+    @property
+    def length(self):
+        return self.alignment.length
+
+
+# the number of reads called as each barcode so far (by this process) which is used to order the
+# search for a read's barcode when exiting early and to prune the panel
+observed_calls = {}
+
+# the numbers of alignments done and skipped (and of the read ends found and not found in the fragment
+# cache) by this thread since they were last collected
+local_counts = threading.local()
+
+# the alignment counts collected from all the workers (in the main process)
+alignment_counts = {'aligned': 0, 'skipped': 0, 'cache_hits': 0, 'cache_misses': 0}
+alignment_counts_lock = threading.Lock()
+
+# the scores and identities of the read end fragments scored most recently (by this process, oldest
+# first) and their approximate size in bytes, when caching
+fragment_cache = {'entries': OrderedDict(), 'bytes': 0}
+fragment_cache_lock = threading.Lock()
+
+# the arrays used to bound the identities of the barcodes at each end of a panel that don't depend on
+# the read end (by the panel's cache_key and end, its kmer_size and the alignment settings, see
+# get_bound_tables)
+bound_tables = {}
+
 def set_alignment_settings(open, extend, matrix):
     global gap_open, gap_extend, nuc_matrix
 
@@ -32,154 +101,556 @@ def set_alignment_settings(open, extend, matrix):
     gap_extend = extend
     nuc_matrix = matrix
 
-def best_read_identity(reads, barcodes, barcode_set):
-    start_identities = {}
-    end_identities = {}
+def init_alignment_worker(scoring_scheme_vals):
+    '''
+    Sets up the alignment globals in a worker process (the parasail matrix can't be pickled so
+    it is created in each process from the scoring scheme: match, mismatch, gap open, gap extend)
+    '''
+    set_alignment_settings(-scoring_scheme_vals[2],
+                           -scoring_scheme_vals[3],
+                           parasail.matrix_create("ACGT", scoring_scheme_vals[0], scoring_scheme_vals[1]))
 
-    for barcode_id in barcodes:
-        start_identities[barcode_id] = 0
-        end_identities[barcode_id] = 0
+def score_reads(queries, panel):
+    '''
+    Aligns both ends of each read against every barcode in a panel (for the preflight check of which
+    barcodes are present)
+    :param queries: tuples of the name and the first and last read_fragment_length bases of each read
+    :return: a list of the panel scores of each read: a tuple of the NumPy arrays of the scores and
+    identities of each barcode at its start and end (which demux_read can be given so the read isn't
+    aligned again)
+    '''
+    return [score_panel(query[1], panel['start'], True) + score_panel(query[2], panel['end'], True)
+            for query in queries]
 
-        # Look at alignment of just the barcode, not the extended adapter sequence
-        start_adapter_seq = barcodes[barcode_id]['start']
-        end_adapter_seq = barcodes[barcode_id]['end']
 
-        for read in reads:
-            query_start = str(read.seq)[:read_fragment_length]
-            result_start = get_all(barcode_id, query_start, start_adapter_seq, gap_open, gap_extend, nuc_matrix)
-            if result_start['identity'] > start_identities[barcode_id]:
-                start_identities[barcode_id] = result_start['identity']
+def get_barcode_panel(barcodes, prefilter_top=0, kmer_size=5, early_exit=False, prune_after=0, prune_below=0,
+                      cache_size=0):
+    '''
+    Returns the barcodes as a panel: lists of their ids and their start and end sequences (in the
+    same order) which are aligned against each end of a read with score_read_end. If prefilter_top is
+    given (and is less than the number of barcodes) the panel has an index of the barcodes' k-mers
+    so that only the prefilter_top barcodes sharing the most k-mers with a read end are aligned. The
+    index is also used to bound the identities of barcodes when exiting early. If prune_after is given,
+    the barcodes that at most the prune_below fraction of reads have been called as (i.e., none by
+    default) are pruned once that many reads have been demuxed (see get_pruned). If cache_size is given,
+    the scores of up to about that many bytes of read end fragments are cached (see get_read_end_scores).
+    '''
+    ids = list(barcodes)
+    panel = {
+        'ids': ids,
+        'start': [barcodes[barcode_id]['start'] for barcode_id in ids],
+        'end': [barcodes[barcode_id]['end'] for barcode_id in ids],
+        'prefilter_top': prefilter_top if 0 < prefilter_top < len(ids) else 0,
+        'kmer_size': kmer_size,
+        'early_exit': early_exit,
+        'prune_after': prune_after,
+        'prune_below': prune_below,
+        'cache_size': cache_size
+    }
+    # identifies the panel's barcodes in the keys of the fragment cache
+    panel['cache_key'] = hash((tuple(ids), tuple(panel['start']), tuple(panel['end'])))
+    if panel['prefilter_top'] or early_exit:
+        for end in ['start', 'end']:
+            panel[end + '_lengths'] = np.array([len(sequence) if sequence else 0 for sequence in panel[end]])
+            panel[end + '_width'] = max(panel[end + '_lengths'].max(), kmer_size)
+            panel[end + '_kmers'] = get_kmer_index(panel[end], kmer_size, panel[end + '_width'])
+            panel[end + '_suffixes'] = get_suffix_index(panel[end])
+    return panel
+
+def get_kmer_index(sequences, kmer_size, width):
+    '''
+    Returns a dictionary of the k-mers in the barcode sequences to their positions, as indices into
+    an array of the k-mer positions of every barcode (one row per barcode of width - kmer_size + 1)
+    '''
+    positions = width - kmer_size + 1
+    index = {}
+    for barcode_index, sequence in enumerate(sequences):
+        if sequence is None:
+            continue
+        for i in range(len(sequence) - kmer_size + 1):
+            index.setdefault(sequence[i:i + kmer_size], []).append(barcode_index * positions + i)
+    return index
+
+def get_suffix_index(sequences):
+    '''
+    Returns a dictionary of the proper suffixes of the barcode sequences to the indices of the barcodes
+    that end with them and the lengths of the rest of the barcodes
+    '''
+    index = {}
+    for barcode_index, sequence in enumerate(sequences):
+        if sequence is None:
+            continue
+        for i in range(1, len(sequence)):
+            index.setdefault(sequence[i:], []).append((barcode_index, i))
+    return index
+
+def find_shared_kmers(query, kmer_index, kmer_size, shape):
+    '''
+    Finds the k-mers of each barcode that are found in a read end
+    :return: a boolean NumPy array of the barcodes' k-mer positions (of the shape given)
+    '''
+    hits = []
+    for kmer in {query[i:i + kmer_size] for i in range(len(query) - kmer_size + 1)}:
+        if kmer in kmer_index:
+            hits.extend(kmer_index[kmer])
+    found = np.zeros(shape[0] * shape[1], dtype=bool)
+    found[hits] = True
+    return found.reshape(shape)
+
+def get_candidates(counts, top):
+    '''
+    Returns the indices of the top barcodes by their counts of shared k-mers (and any tied with them)
+    '''
+    least = np.partition(counts, len(counts) - top)[len(counts) - top]
+    return np.flatnonzero(counts >= least)
+
+def get_gap_penalties(lengths):
+    '''
+    Returns the penalties of gaps of the lengths (a NumPy array) with the alignment gap settings
+    '''
+    return np.where(lengths > 0, gap_open + gap_extend * (lengths - 1), 0)
 
-            query_end = str(read.seq)[-read_fragment_length:]
-            result_end = get_all(barcode_id, query_end, end_adapter_seq, gap_open, gap_extend, nuc_matrix)
-            if result_end['identity'] > end_identities[barcode_id]:
-                end_identities[barcode_id] = result_end['identity']
+def get_bound_tables(panel, end):
+    '''
+    Returns the arrays used by get_identity_bounds for one end of a panel (made the first time they are
+    needed for the panel's barcodes and kmer_size with the alignment settings): the number of bases of
+    each barcode that are aligned after each overhang and the best scores of those alignments (all
+    matches), the scores of aligning each k-mer of each barcode (with the rest of the barcode as gaps
+    either side), and the identities of m aligned bases with e edits.
+    '''
+    match = nuc_matrix.max
+    key = (panel['cache_key'], end, panel['kmer_size'], gap_open, gap_extend, match)
+    if key not in bound_tables:
+        lengths, kmer_size, width = panel[end + '_lengths'], panel['kmer_size'], panel[end + '_width']
+        overhangs = np.arange(width)
+        aligned = np.maximum(lengths[:, None] - overhangs, 0)
+        kmer_starts = np.arange(width - kmer_size + 1)
+        kmer_scores = match * kmer_size - get_gap_penalties(kmer_starts) - \
+            get_gap_penalties(lengths[:, None] - kmer_starts - kmer_size)
+        identities = np.arange(width + 1)[:, None] / np.maximum(np.add.outer(np.arange(width + 1),
+                                                                              np.arange(width + 1)), 1)
+        bound_tables[key] = {
+            'aligned': aligned,
+            'overhang_scores': np.where(aligned > 0, match * aligned - get_gap_penalties(overhangs), -np.inf),
+            'kmer_scores': np.where(kmer_starts <= lengths[:, None] - kmer_size, kmer_scores, -np.inf),
+            'identities': identities
+        }
+    return bound_tables[key]
 
-    return start_identities, end_identities
+def get_identity_bounds(query, found, panel, end):
+    '''
+    Returns upper bounds on the identities of the barcodes at one end of a panel to a read end. Each edit
+    in an alignment removes at most kmer_size of the k-mers of the aligned part of a barcode, so if m
+    bases are aligned there are at least e = (m - k + 1 - shared) / k edits (with only the k-mers in that
+    part counted) and the identity (matches / alignment length) is at most m / (m + e). Usually m is
+    the barcode's length L but parasail doesn't count the bases of a barcode hanging off the start of
+    the read end in the alignment length, so every overhang of h = L - m bases is bounded too. Those
+    alignments start at the first base of the read end, so one without edits must match it exactly,
+    and an overhang is only possible if it could score as well as an alignment known to exist (of a
+    shared k-mer, or of an overhang that matches exactly).
+    :param found: a boolean array of the barcodes' k-mers that are found in the read end (see
+    find_shared_kmers)
+    '''
+    tables = get_bound_tables(panel, end)
+    aligned = tables['aligned']
+    n_barcodes, width = aligned.shape
+
+    # the shared k-mers at or after each position of each barcode
+    shared = np.zeros((n_barcodes, width), dtype=int)
+    shared[:, :found.shape[1]] = np.cumsum(found[:, ::-1], axis=1)[:, ::-1]
+
+    # the overhangs after which a barcode matches the start of the read end exactly
+    exact = np.zeros((n_barcodes, width), dtype=bool)
+    suffix_index = panel[end + '_suffixes']
+    for length in range(1, min(width, len(query) + 1)):
+        for barcode_index, overhang in suffix_index.get(query[:length], ()):
+            exact[barcode_index, overhang] = True
+
+    least_scores = np.maximum(np.where(found, tables['kmer_scores'], -np.inf).max(axis=1),
+                              np.where(exact, tables['overhang_scores'], -np.inf).max(axis=1))
+    possible = tables['overhang_scores'] >= least_scores[:, None]
+    possible[:, 0] = True
+
+    edits = np.maximum((aligned - shared) // panel['kmer_size'], 0)
+    edits[:, 1:] += (edits[:, 1:] == 0) & ~exact[:, 1:]
+    return np.where(possible, tables['identities'][aligned, edits], 0).max(axis=1)
+
+def get_observed_calls(ids):
+    '''
+    Returns an array of the number of reads called as each barcode so far
+    '''
+    return np.array([observed_calls.get(barcode_id, 0) for barcode_id in ids])
 
+def get_pruned(ids, prune_after, prune_below):
+    '''
+    Returns a boolean array of the barcodes that are pruned: those that at most the prune_below fraction
+    of the reads have been called as, once prune_after reads have been demuxed (or None before then).
+    A pruned barcode is still aligned when the best of the rest isn't a clear match, so as reads are
+    called as it, it is no longer pruned.
+    '''
+    n_reads = sum(observed_calls.values())
+    if n_reads < prune_after:
+        return None
+    return np.array([observed_calls.get(barcode_id, 0) <= prune_below * n_reads for barcode_id in ids])
 
-def demux_read(read, barcodes, barcode_set, single_barcode, threshold, secondary_threshold, score_diff, mode, additional_info, report_alternate_call, verbosity):
+def get_read_end_scores(query, panel, end, with_identity, threshold, score_diff, prior=None, pruned=None):
+    '''
+    Returns the scores and identities of the barcodes in a panel to one end of a read (from
+    score_read_end). When caching, those of a fragment that has been scored recently (e.g., the same
+    amplicon end in many reads) are taken from the fragment cache rather than aligned again (as they
+    were first scored, which only differs with --early_exit or pruning), and the least recently used
+    fragments are dropped to keep the cache to the panel's cache_size.
     '''
-    Processes a read to find barcodes and returns the results
-    :param name: The name of the read
-    :param read:  The sequence
+    if not panel['cache_size']:
+        return score_read_end(query, panel, end, with_identity, threshold, score_diff, prior, pruned)
+
+    key = (panel['cache_key'], end, with_identity, query)
+    with fragment_cache_lock:
+        cached = fragment_cache['entries'].get(key)
+        if cached is not None:
+            fragment_cache['entries'].move_to_end(key)
+    count_cache(cached is not None)
+    if cached is not None:
+        # copies as the arrays are filled in by align_ties
+        return cached[0].copy(), cached[1].copy()
+
+    scores, identities = score_read_end(query, panel, end, with_identity, threshold, score_diff, prior, pruned)
+    size = sys.getsizeof(key) + sys.getsizeof(query) + 2 * sys.getsizeof(scores)
+    with fragment_cache_lock:
+        entries = fragment_cache['entries']
+        if key not in entries:
+            entries[key] = (scores.copy(), identities.copy(), size)
+            fragment_cache['bytes'] += size
+            while fragment_cache['bytes'] > panel['cache_size'] and entries:
+                fragment_cache['bytes'] -= entries.popitem(last=False)[1][2]
+
+    return scores, identities
+
+def score_read_end(query, panel, end, with_identity, threshold, score_diff, prior=None, pruned=None):
     '''
-    query_start = str(read.seq)[:read_fragment_length]
-    query_end = str(read.seq)[-read_fragment_length:]
+    Scores one end of a read against the barcodes in a panel. With a prefilter, only the candidate
+    barcodes that share the most k-mers with the read end are aligned, unless the best of them isn't
+    a clear match (less than score_diff over the threshold or, for identities, within score_diff of
+    the next best) when the rest of the barcodes are aligned too. The pruned barcodes (a boolean array,
+    if any) aren't candidates so they are only aligned to confirm that there isn't a better match
+    than an unclear best candidate. When exiting early (for identities)
+    the barcodes are aligned in order of their prior (e.g., the number of reads called as them so far)
+    and then of their shared k-mers, and any that can't come within score_diff of the best so far (by
+    their identity bounds) are skipped.
+    :return: NumPy arrays of the scores and identities (all 0 unless with_identity) of each barcode
+    (-inf for those that weren't aligned)
+    '''
+    references = panel[end]
+    early_exit = panel['early_exit'] and with_identity
+    if pruned is not None and (pruned.all() or not pruned.any()):
+        pruned = None
+    if not panel['prefilter_top'] and not early_exit and pruned is None:
+        return score_panel(query, references, with_identity)
+
+    score_diff = score_diff or 0
+    counts = None
+    if panel['prefilter_top'] or early_exit:
+        found = find_shared_kmers(query, panel[end + '_kmers'], panel['kmer_size'],
+                                  (len(references), panel[end + '_width'] - panel['kmer_size'] + 1))
+        counts = found.sum(axis=1)
+    bounds = None
+    order = np.arange(len(references))
+    if early_exit:
+        bounds = get_identity_bounds(query, found, panel, end)
+        order = np.lexsort((-counts, -prior)) if prior is not None else np.argsort(-counts, kind='stable')
+
+    scores = np.full(len(references), -np.inf)
+    identities = np.full(len(references), -np.inf)
+    remaining = order
+
+    candidates = None
+    if panel['prefilter_top']:
+        candidates = get_candidates(counts if pruned is None else np.where(pruned, -1, counts),
+                                    panel['prefilter_top'])
+    elif pruned is not None:
+        candidates = np.flatnonzero(~pruned)
+
+    if candidates is not None:
+        align_panel(query, references, with_identity, candidates, scores, identities, bounds, score_diff)
+
+        # a barcode that wasn't aligned could still be close to the best candidate
+        if with_identity:
+            ranked = np.sort(identities[candidates])[::-1]
+            clear = len(ranked) > 1 and ranked[0] >= threshold + score_diff and ranked[0] >= ranked[1] + score_diff
+        else:
+            best = candidates[np.argmax(scores[candidates])]
+            clear = references[best] is not None and \
+                get_identity(None, query, references[best], gap_open, gap_extend, nuc_matrix)['identity'] >= \
+                threshold + score_diff
 
-    results = []
+        remaining = order[~np.isin(order, candidates)]
+        if clear:
+            count_alignments(0, sum(1 for index in remaining if references[index] is not None))
+            return scores, identities
 
-    for barcode_id in barcodes:
-        start_adapter_seq = barcodes[barcode_id]['start']
-        end_adapter_seq = barcodes[barcode_id]['end']
+    align_panel(query, references, with_identity, remaining, scores, identities, bounds, score_diff)
 
-        if mode == 'porechop':
-            result_start = get_identity(barcode_id, query_start, start_adapter_seq, gap_open, gap_extend,
-                                     nuc_matrix)
-            result_end = get_identity(barcode_id, query_end, end_adapter_seq, gap_open, gap_extend, nuc_matrix)
-        else:
-            result_start = get_score(barcode_id, query_start, start_adapter_seq, gap_open, gap_extend, nuc_matrix)
-            result_end = get_score(barcode_id, query_end, end_adapter_seq, gap_open, gap_extend, nuc_matrix)
-        results.append(combine_results(result_start, result_end))
+    return scores, identities
 
-    if mode == 'porechop':
-        results.sort(key=lambda k: (-k['start_identity'], -k['end_identity']))
+def score_panel(query, references, with_identity):
+    '''
+    Aligns one end of a read against every barcode sequence in a panel
+    :return: NumPy arrays of the scores and identities (all 0 unless with_identity) of each barcode
+    '''
+    scores = np.zeros(len(references))
+    identities = np.zeros(len(references))
+
+    align_panel(query, references, with_identity, range(len(references)), scores, identities)
+
+    return scores, identities
+
+def align_panel(query, references, with_identity, indices, scores, identities, bounds=None, score_diff=0):
+    '''
+    Aligns one end of a read against the barcode sequences at the indices, filling in their scores
+    and identities. If bounds on the identities are given, barcodes that can't come within score_diff
+    of the best identity so far are skipped.
+    '''
+    aligned = 0
+    skipped = 0
+
+    if with_identity:
+        best = identities.max() if bounds is not None and len(identities) else -np.inf
+
+        # parasail's semi-global stats functions crash when given a query profile so each barcode
+        # is aligned in full to get the matches and length
+        for index in indices:
+            reference = references[index]
+            if reference is None:
+                scores[index] = identities[index] = 0
+                continue
+            if bounds is not None and bounds[index] < best - score_diff:
+                skipped += 1
+                continue
+            stats = parasail.sg_qx_stats_striped_sat(query, reference, gap_open, gap_extend, nuc_matrix)
+            scores[index] = stats.score
+            identities[index] = stats.matches / stats.length
+            best = max(best, identities[index])
+            aligned += 1
     else:
-        results.sort(key=lambda k: (-k['start_score'], -k['end_score']))
-    start_best = get_all(results[0]['id'], query_start, barcodes[results[0]['id']]['start'], gap_open,
-                         gap_extend, nuc_matrix)
-    if additional_info or mode == "lenient":
-        start_best_end = get_all(results[0]['id'], query_end, barcodes[results[0]['id']]['end'], gap_open,
-                                 gap_extend, nuc_matrix)
-        start_best = combine_results(start_best, start_best_end, start_best)
-    start_second_best = None
-    if mode == 'porechop' and len(results) > 1:
-        start_second_best = get_all(results[1]['id'], query_start, barcodes[results[1]['id']]['start'], gap_open,
-                         gap_extend, nuc_matrix)
+        # the striped query profile of the read end is only built once for the whole panel
+        profile = parasail.profile_create_sat(query, nuc_matrix)
+        for index in indices:
+            reference = references[index]
+            if reference is None:
+                scores[index] = identities[index] = 0
+                continue
+            scores[index] = parasail.sg_qx_striped_profile_sat(profile, reference, gap_open, gap_extend).score
+            identities[index] = 0
+            aligned += 1
+
+    count_alignments(aligned, skipped)
+
+def align_ties(ranking, query, references, with_identity, scores, identities):
+    '''
+    Aligns this end of a read to any barcodes that are tied for the best by their ranking values (at
+    the other end) but weren't aligned here, so the tie is broken as it would be with every barcode
+    aligned
+    '''
+    tied = np.flatnonzero(ranking == ranking.max())
+    if len(tied) > 1:
+        values = identities if with_identity else scores
+        missing = tied[values[tied] == -np.inf]
+        if len(missing):
+            align_panel(query, references, with_identity, missing, scores, identities)
+
+def get_local_counts():
+    counts = getattr(local_counts, 'counts', None)
+    if counts is None:
+        counts = local_counts.counts = dict.fromkeys(alignment_counts, 0)
+    return counts
+
+def count_alignments(aligned, skipped):
+    counts = get_local_counts()
+    counts['aligned'] += aligned
+    counts['skipped'] += skipped
+
+def count_cache(hit):
+    counts = get_local_counts()
+    counts['cache_hits' if hit else 'cache_misses'] += 1
+
+def collect_alignment_counts():
+    '''
+    Returns this thread's counts of alignments done and skipped and of fragment cache hits and misses
+    (resetting them)
+    '''
+    counts = getattr(local_counts, 'counts', None)
+    local_counts.counts = None
+    return counts
+
+def merge_alignment_counts(counts):
+    '''
+    Adds the alignment counts collected from a worker to the totals
+    '''
+    if not counts:
+        return
+    with alignment_counts_lock:
+        for key in alignment_counts:
+            alignment_counts[key] += counts[key]
+
+def rank_panel(primary, secondary):
+    '''
+    Returns the indices of the best and second best barcodes (or None if there is only one) ranked
+    by the primary values and then the secondary values. Ties keep the panel order.
+    '''
+    order = np.lexsort((-secondary, -primary))
+    return order[0], (order[1] if len(order) > 1 else None)
+
+def get_alignment_plan(single_barcode, mode, additional_info, report_alternate_call, extended_info, verbosity):
+    '''
+    Works out which alignments demux_read needs for a run's settings (once, rather than for each read)
+    :return: a dictionary of whether the best barcode at the secondary end of a read needs its own
+    alignment ('secondary': for a call needing two barcodes, lenient mode or when it is written out or
+    printed), whether the second best barcode at the secondary end is needed ('secondary_second':
+    for a call needing two barcodes in porechop mode), whether the best barcodes are aligned to both
+    ends of the read ('both_ends': for lenient mode, the summary info or the stringent mode's reasons
+    for not calling a barcode) and whether the alignments are traced ('traces': only for printing)
+    '''
+    # the alternate call is made with the opposite single_barcode setting
+    two_barcodes = not single_barcode or report_alternate_call
+
+    return {
+        'secondary': two_barcodes or mode == 'lenient' or additional_info or extended_info or verbosity > 1,
+        'secondary_second': two_barcodes and mode == 'porechop',
+        'both_ends': additional_info or mode == 'lenient' or (mode == 'stringent' and verbosity > 2),
+        'traces': verbosity > 1
+    }
+
+def demux_read(read, panel, plan, barcode_set, single_barcode, threshold, secondary_threshold, score_diff, mode, report_alternate_call, verbosity):
+    '''
+    Processes a read to find barcodes and returns the results as a DemuxResult
+    :param read: A tuple of the read's name and the first and last read_fragment_length bases of
+    its sequence (as the first three items of a reader.Read), optionally followed by its panel scores
+    if the read has already been aligned against every barcode in the panel (by score_reads)
+    :param panel: The barcodes to look for (from get_barcode_panel)
+    :param plan: The alignments that are needed (from get_alignment_plan)
+    '''
+    name, query_start, query_end = read[:3]
+    ids = panel['ids']
+
+    # the alignments of this read keyed by (is_start, barcode_id) so each one is only done once
+    alignments = {}
+
+    with_identity = mode == 'porechop'
+    pruned = None
+    if len(read) > 3 and read[3] is not None:
+        start_scores, start_identities, end_scores, end_identities = read[3]
+    else:
+        prior = get_observed_calls(ids) if panel['early_exit'] else None
+        pruned = get_pruned(ids, panel['prune_after'], panel['prune_below']) if panel['prune_after'] else None
+        start_scores, start_identities = get_read_end_scores(query_start, panel, 'start', with_identity, threshold,
+                                                             score_diff, prior, pruned)
+        end_scores, end_identities = get_read_end_scores(query_end, panel, 'end', with_identity, threshold,
+                                                         score_diff, prior, pruned)
+    if panel['prefilter_top'] or panel['early_exit'] or pruned is not None:
+        align_ties(end_identities if with_identity else end_scores, query_start, panel['start'], with_identity,
+                   start_scores, start_identities)
+        align_ties(start_identities if with_identity else start_scores, query_end, panel['end'], with_identity,
+                   end_scores, end_identities)
 
     if mode == 'porechop':
-        results.sort(key=lambda k: (-k['end_identity'], -k['start_identity']))
+        start_index, start_second = rank_panel(start_identities, end_identities)
+        end_index, end_second = rank_panel(end_identities, start_identities)
     else:
-        results.sort(key=lambda k: (-k['end_score'], -k['start_score']))
-    end_best = get_all(results[0]['id'], query_end, barcodes[results[0]['id']]['end'], gap_open, gap_extend,
-                       nuc_matrix)
-    if additional_info or mode == "lenient":
-        end_best_start = get_all(results[0]['id'], query_start, barcodes[results[0]['id']]['start'], gap_open,
-                                 gap_extend, nuc_matrix)
-        end_best = combine_results(end_best_start, end_best, end_best)
+        start_index, start_second = rank_panel(start_scores, end_scores)
+        end_index, end_second = rank_panel(end_scores, start_scores)
+
+    if plan['secondary'] or mode != 'porechop':
+        start_best = get_best_result(alignments, panel, plan, start_index, True, query_start, query_end)
+        end_best = get_best_result(alignments, panel, plan, end_index, False, query_start, query_end)
+    else:
+        # the identities of the best barcodes are already known so only the primary end's is aligned
+        # again (for its matches and length)
+        start_best = get_panel_result(panel, start_index, 'start', query_start, start_scores, start_identities)
+        end_best = get_panel_result(panel, end_index, 'end', query_end, end_scores, end_identities)
+        if start_best.identity >= end_best.identity:
+            start_best = get_best_result(alignments, panel, plan, start_index, True, query_start, query_end)
+            end_best = BarcodeMatch(0, None, end_best)
+        else:
+            start_best = BarcodeMatch(1, start_best, None)
+            end_best = get_best_result(alignments, panel, plan, end_index, False, query_start, query_end)
+    is_start = start_best.identity >= end_best.identity
+
+    # only the identities of the second best barcodes are used so they aren't aligned again
+    start_second_best = None
     end_second_best = None
-    if mode == 'porechop' and len(results) > 1:
-        end_second_best = get_all(results[1]['id'], query_end, barcodes[results[1]['id']]['end'], gap_open,
-                         gap_extend, nuc_matrix)
+    if mode == 'porechop':
+        if start_second is not None and (is_start or plan['secondary_second']):
+            start_second_best = get_panel_result(panel, start_second, 'start', query_start, start_scores,
+                                                 start_identities)
+        if end_second is not None and (not is_start or plan['secondary_second']):
+            end_second_best = get_panel_result(panel, end_second, 'end', query_end, end_scores, end_identities)
 
     #if verbosity > 2:
     #    print(read.name + ": ")
     #    print_alignment(start_best, end_best)
     #    print("\n\n")
 
-    if start_best['identity'] >= end_best['identity']:
+    if is_start:
         primary = start_best
-        primary['start'] = 1
         primary_second = start_second_best
         secondary = end_best
-        secondary['start'] = 0
         secondary_second = end_second_best
     else:
         primary = end_best
-        primary['start'] = 0
         primary_second = end_second_best
         secondary = start_best
-        secondary['start'] = 1
         secondary_second = start_second_best
 
-    if mode == 'lenient':
-        primary['dominant'] = 1
-    else:
-        primary['dominant'] = 0
-
     call = call_barcode(primary, secondary, primary_second, secondary_second, single_barcode, threshold, secondary_threshold, score_diff, mode, verbosity)
+    if panel['early_exit'] or panel['prune_after']:
+        observed_calls[call] = observed_calls.get(call, 0) + 1
     alt_call = None
     if report_alternate_call:
         alt_call = call_barcode(primary, secondary, primary_second, secondary_second, not single_barcode, threshold, secondary_threshold, score_diff, mode, verbosity)
 
+    return DemuxResult(name, call, alt_call, primary, secondary)
 
-    return {
-        'name': read.name,
-        'call': call,
-        'alt_call': alt_call,
-        'primary': primary,
-        'secondary': secondary
-    }
-
-
-def combine_results(start_result, end_result, primary_result=None):
-    all_results = {}
-    if primary_result:
-        for key in primary_result:
-            all_results[key] = primary_result[key]
+def get_best_result(alignments, panel, plan, index, is_start, query_start, query_end):
+    '''
+    Returns the alignment of the best barcode at one end of a read as a BarcodeMatch (with its
+    alignment at the other end too if the plan needs both ends)
+    '''
+    barcode_id = panel['ids'][index]
+    start_result = end_result = None
+    if is_start or plan['both_ends']:
+        start_result = get_cached_alignment(alignments, barcode_id, True, query_start, panel['start'][index],
+                                            plan['traces'])
+    if not is_start or plan['both_ends']:
+        end_result = get_cached_alignment(alignments, barcode_id, False, query_end, panel['end'][index],
+                                          plan['traces'])
+
+    return BarcodeMatch(1 if is_start else 0, start_result, end_result)
+
+def get_panel_result(panel, index, end, query, scores, identities):
+    '''
+    Returns the Alignment of a barcode to one end of a read with its score and identity from the
+    arrays filled in by score_read_end (aligning it now if it was skipped there)
+    '''
+    if identities[index] == -np.inf:
+        return get_stats(panel['ids'][index], query, panel[end][index], gap_open, gap_extend, nuc_matrix)
 
-    all_results['id'] = start_result['id']
-    for key in start_result:
-        all_results["start_%s" %key] = start_result[key]
-    for key in end_result:
-        all_results["end_%s" %key] = end_result[key]
+    return Alignment(panel['ids'][index], int(scores[index]), float(identities[index]), None, None, None, None)
 
-    return all_results
 
 def call_barcode_stringent_mode(primary, secondary, threshold, secondary_threshold, verbosity):
 
-    if primary['identity'] >= threshold and secondary['identity'] >= secondary_threshold \
-            and primary['id'] == secondary['id']:
-        return primary['id']
+    if primary.identity >= threshold and secondary.identity >= secondary_threshold \
+            and primary.id == secondary.id:
+        return primary.id
 
     elif verbosity > 2:
-        if primary['identity'] >= threshold and primary['start'] == 1 \
-            and primary['end_identity'] >= secondary_threshold:
+        if primary.identity >= threshold and primary.is_start == 1 \
+            and primary.end.identity >= secondary_threshold:
             return 'mismatched_barcode'
-        elif primary['identity'] >= threshold and primary['start'] == 0 \
-                and primary['start_identity'] >= secondary_threshold:
+        elif primary.identity >= threshold and primary.is_start == 0 \
+                and primary.start.identity >= secondary_threshold:
             return 'mismatched_barcode'
-        elif primary['identity'] >= threshold:
+        elif primary.identity >= threshold:
             return 'low_secondary_identity'
         else:
             return 'low_primary_identity'
@@ -188,34 +659,34 @@ def call_barcode_stringent_mode(primary, secondary, threshold, secondary_thresho
 
 def call_barcode_lenient_mode(primary, secondary, threshold, secondary_threshold, verbosity):
 
-    if primary['start'] == 1 and primary['start_identity'] >= threshold and secondary['end_identity'] >= secondary_threshold:
-        return primary['id']
-    elif primary['start'] == 0 and primary['end_identity'] >= threshold and secondary['start_identity'] >= secondary_threshold:
-        return primary['id']
+    if primary.is_start == 1 and primary.start.identity >= threshold and secondary.end.identity >= secondary_threshold:
+        return primary.id
+    elif primary.is_start == 0 and primary.end.identity >= threshold and secondary.start.identity >= secondary_threshold:
+        return primary.id
 
     elif verbosity > 2:
-        if primary['start'] == 1 and primary['start_identity'] >= threshold:
+        if primary.is_start == 1 and primary.start.identity >= threshold:
             return 'low_secondary_identity'
-        elif primary['start'] == 0 and primary['end_identity'] >= threshold:
+        elif primary.is_start == 0 and primary.end.identity >= threshold:
             return 'low_secondary_identity'
-        elif primary['start'] == 1 and primary['end_identity'] >= secondary_threshold:
+        elif primary.is_start == 1 and primary.end.identity >= secondary_threshold:
             return 'low_primary_identity'
-        elif primary['start'] == 0 and primary['end_identity'] >= secondary_threshold:
+        elif primary.is_start == 0 and primary.end.identity >= secondary_threshold:
             return 'low_primary_identity'
 
     return 'unassigned'
 
 def call_barcode_porechop_mode(primary, secondary, primary_second, secondary_second, single_barcode, threshold, score_diff, verbosity):
 
-    primary_over_threshold = (primary['identity'] >= threshold)
-    primary_good_diff = (primary_second is None or primary['identity'] >= primary_second['identity'] + score_diff)
-    secondary_over_threshold = (secondary['identity'] >= threshold)
-    secondary_good_diff = (secondary_second is None or secondary['identity'] >= secondary_second['identity'] + score_diff)
-    ids_match = (primary['id'] == secondary['id'])
+    primary_over_threshold = (primary.identity >= threshold)
+    primary_good_diff = (primary_second is None or primary.identity >= primary_second.identity + score_diff)
+    secondary_over_threshold = (secondary.identity >= threshold)
+    secondary_good_diff = (secondary_second is None or secondary.identity >= secondary_second.identity + score_diff)
+    ids_match = (primary.id == secondary.id)
 
     if single_barcode:
         if primary_over_threshold and primary_good_diff:
-            return primary['id']
+            return primary.id
 
         elif verbosity > 2:
             if not primary_over_threshold:
@@ -224,7 +695,7 @@ def call_barcode_porechop_mode(primary, secondary, primary_second, secondary_sec
                 return 'bad_primary_diff'
     else:
         if ids_match and primary_over_threshold and primary_good_diff and secondary_over_threshold and secondary_good_diff:
-            return primary['id']
+            return primary.id
 
         elif verbosity > 2:
             if not ids_match:
@@ -248,8 +719,8 @@ def call_barcode(primary, secondary, primary_second, secondary_second, single_ba
                                           threshold, score_diff, verbosity)
 
     if single_barcode:
-        if primary['identity'] >= threshold:
-            return primary['id']
+        if primary.identity >= threshold:
+            return primary.id
 
     if mode == "stringent":
         return call_barcode_stringent_mode(primary, secondary, threshold, secondary_threshold, verbosity)
@@ -259,26 +730,38 @@ def call_barcode(primary, secondary, primary_second, secondary_second, single_ba
     return 'unassigned'
 
 
-def print_result(result):
-    start = result['primary'] if result['primary']['start'] == 1 else result['secondary']
-    print(result['primary']['dominant'])
-    end = result['secondary'] if result['secondary']['start'] == 0 and result['primary']['dominant'] == 0 else result['primary']
+def print_result(result, dominant):
+    '''
+    Prints the alignments of a read's best barcodes (with dominant, as in lenient mode, both of the
+    alignments printed are the primary barcode's)
+    '''
+    start = result.primary if result.primary.is_start == 1 else result.secondary
+    print(1 if dominant else 0)
+    end = result.secondary if result.secondary.is_start == 0 and not dominant else result.primary
 
-    print(result['name'] + ": " + result['call'])
-    print_alignment(start, end)
+    print(result.name + ": " + result.call)
+    print_alignment(start.alignment, end.alignment)
 
 
 
 def print_alignment(start, end):
-    print("Start: " + start['id'], "| score:", start['score'], "| identity:", "{:.2f}".format(start['identity']),
-          "| similarity:", "{:.2f}".format(start['similarity']), "| matches:", start['matches'],
-          "| mismatches:", start['mismatches'], "| length:", start['length'])
-    print("  End: " + end['id'], "| score:", end['score'], "| identity:", "{:.2f}".format(end['identity']),
-          "| similarity:", "{:.2f}".format(end['similarity']), "| matches:", end['matches'],
-          "| mismatches:", end['mismatches'], "| length:", end['length'])
-    print(start['trace']['ref'] + " .... " + end['trace']['ref'] + "\n" +
-          start['trace']['comp'] + " .... " + end['trace']['comp'] + "\n" +
-          start['trace']['query'] + " .... " + end['trace']['query'] + "\n")
+    print("Start: " + start.id, "| score:", start.score, "| identity:", "{:.2f}".format(start.identity),
+          "| similarity:", "{:.2f}".format(get_similarity(start)), "| matches:", start.matches,
+          "| mismatches:", start.mismatches, "| length:", start.length)
+    print("  End: " + end.id, "| score:", end.score, "| identity:", "{:.2f}".format(end.identity),
+          "| similarity:", "{:.2f}".format(get_similarity(end)), "| matches:", end.matches,
+          "| mismatches:", end.mismatches, "| length:", end.length)
+    print(start.trace['ref'] + " .... " + end.trace['ref'] + "\n" +
+          start.trace['comp'] + " .... " + end.trace['comp'] + "\n" +
+          start.trace['query'] + " .... " + end.trace['query'] + "\n")
+
+
+def get_similarity(alignment):
+    '''
+    The proportion of the aligned (not gapped) bases of an alignment that match
+    '''
+    aligned = alignment.matches + alignment.mismatches
+    return alignment.matches / aligned if aligned else 0
 
 
 def get_score(id, query, reference, open, extend, matrix):
@@ -325,91 +808,89 @@ def get_identity(id, query, reference, open, extend, matrix):
 
 
 def get_stats(id, query, reference, open, extend, matrix):
+    '''
+    Returns the Alignment of a barcode to one end of a read without its trace (or mismatches, which
+    parasail's stats functions don't count)
+    '''
     if reference is None:
-        result = {
-            'id': id,
-            'matches': 0,
-            'length': 0,
-            'score': 0,
-            'identity': 0
-        }
-        return result
+        return Alignment(id, 0, 0, 0, 0, None, None)
 
     # stats = parasail.sw_stats_striped_8(query, reference, open, extend, matrix)
     stats = parasail.sg_qx_stats_striped_sat(query, reference, open, extend, matrix)
 
-    result = {
-        'id': id,
-        'matches': stats.matches,
-        'length': stats.length,
-        'score': stats.score,
-        'identity': stats.matches / stats.length
-    }
+    result = Alignment(id, stats.score, stats.matches / stats.length, stats.matches, stats.length, None, None)
 
     del stats
 
     return result
 
 
+def get_cached_alignment(alignments, id, is_start, query, reference, with_trace=False):
+    '''
+    Returns the alignment of a barcode to one end of a read, using the read's dictionary of
+    alignments so that each (end, barcode) pair is only aligned once. The traceback (and the
+    mismatches counted from it) is only generated if with_trace (i.e., to be printed).
+    '''
+    key = (is_start, id)
+    if key not in alignments:
+        if with_trace:
+            alignments[key] = get_all(id, query, reference, gap_open, gap_extend, nuc_matrix)
+        else:
+            alignments[key] = get_stats(id, query, reference, gap_open, gap_extend, nuc_matrix)
+    return alignments[key]
+
+def get_alignment_length(traceback):
+    '''
+    The length of an alignment as parasail's stats functions count it: from the first barcode
+    base (ignoring any of the barcode hanging off the start of the read fragment) to the last
+    '''
+    ref_start = len(traceback.ref) - len(traceback.ref.lstrip('-'))
+    query_start = len(traceback.query) - len(traceback.query.lstrip('-'))
+    return len(traceback.ref.rstrip('-')) - max(ref_start, query_start)
+
 def get_all(id, query, reference, open, extend, matrix):
+    '''
+    Returns the Alignment of a barcode to one end of a read with its trace
+    '''
     if reference is None:
-        result = {
-            'id': id,
-            'matches': 0,
-            'score': 0,
-            'identity': 0,
-            'length': 0,
-            'mismatches': 0,
-            'similarity': 0,
-            'trace': {
-                'cigar': '',
-                'ref': '',
-                'comp': '',
-                'query': '',
-                'query_start': 0,
-                'query_end': 0,
-                'ref_start': 0,
-                'ref_end': 0
-            }
+        trace = {
+            'cigar': '',
+            'ref': '',
+            'comp': '',
+            'query': '',
+            'query_start': 0,
+            'query_end': 0,
+            'ref_start': 0,
+            'ref_end': 0
         }
-        return result
-
-    # stats = parasail.sw_stats(query, reference, open, extend, matrix)
-    stats = parasail.sg_qx_stats_striped_sat(query, reference, open, extend, matrix)
-
-    result = {
-        'id': id,
-        'matches': stats.matches,
-        'score': stats.score,
-        'length': stats.length,
-        'identity': stats.matches / stats.length
-    }
-
-    del stats
+        return Alignment(id, 0, 0, 0, 0, 0, trace)
 
+    # the stats are derived from the traceback rather than running a separate stats alignment
     # trace = parasail.sw_trace(query, reference, open, extend, matrix)
-    trace = parasail.sg_qx_trace_striped_sat(query, reference, open, extend, matrix)
-    traceback = trace.get_traceback()
-    cigar = trace.get_cigar()
-
-    #result['length'] = len(traceback.comp)
-    result['mismatches'] = traceback.comp.count('.')
-    result['similarity'] = result['matches'] / (result['matches'] + result['mismatches'])
-
-    result['trace'] = {
-            'cigar': cigar.decode,
-            'ref': traceback.ref,
-            'comp': traceback.comp,
-            'query': traceback.query,
-            'query_start': cigar.beg_query,
-            'query_end': trace.end_query,
-            'ref_start': cigar.beg_ref,
-            'ref_end': trace.end_ref,
+    result = parasail.sg_qx_trace_striped_sat(query, reference, open, extend, matrix)
+    traceback = result.get_traceback()
+    cigar = result.get_cigar()
+
+    matches = traceback.comp.count('|')
+    length = get_alignment_length(traceback)
+    #length = len(traceback.comp)
+
+    trace = {
+        'cigar': cigar.decode,
+        'ref': traceback.ref,
+        'comp': traceback.comp,
+        'query': traceback.query,
+        'query_start': cigar.beg_query,
+        'query_end': result.end_query,
+        'ref_start': cigar.beg_ref,
+        'ref_end': result.end_ref,
     }
 
-    del trace
+    alignment = Alignment(id, result.score, matches / length, matches, length, traceback.comp.count('.'), trace)
 
-    return result
+    del result
+
+    return alignment
 
 def native_barcode_adapter(barcode_id):
     start_SQK_NSK007 = "AATGTACTTCGTTCAGTTACGTATTGCT"
@@ -0,0 +1,148 @@
+"""
+Copyright 2019 Andrew Rambaut (a.rambaut@ed.ac.uk)
+https://github.com/rambaut/readucks
+
+This module runs the reading, demuxing and writing of an input file as a pipeline: a reader thread
+parses batches of reads into a bounded queue, the calling thread demuxes them (using the worker
+pool) into another bounded queue and a writer thread writes out the results. Reading and writing
+overlap with demuxing, and as a stage blocks when its output queue is full, no more than
+queue_depth batches wait between any two stages.
+
+The time each stage spends blocked (waiting for a batch or for room in its output queue) is
+recorded as its stall time.
+
+This file is part of Readucks. Readucks is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Readucks is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Readucks. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+from queue import Queue, Full
+from time import perf_counter
+
+from . import profiler
+
+# the number of batches that can wait between two stages
+default_queue_depth = 4
+
+# how often (in seconds) a blocked reader checks whether the pipeline has been stopped
+stop_check_interval = 0.1
+
+# the total time each stage has spent stalled (in all the pipelines run by this process)
+stall_times = {'read': 0.0, 'demux': 0.0, 'write': 0.0}
+stall_times_lock = threading.Lock()
+
+# marks the end of the batches in a queue
+end_of_batches = object()
+
+
+def add_stall(stage, seconds):
+    with stall_times_lock:
+        stall_times[stage] += seconds
+
+
+def run_pipeline(batches, demux_func, write_func, queue_depth=default_queue_depth):
+    '''
+    Runs the batches through the demuxer and the writer. The batches are read by a reader thread,
+    demuxed (by demux_func, given the batches and returning an iterator of results) in the calling
+    thread and the results passed to write_func by a writer thread, in order. An error in any stage
+    stops the pipeline and is raised here.
+    '''
+    read_queue = Queue(queue_depth)
+    write_queue = Queue(queue_depth)
+    stop = threading.Event()
+    errors = []
+
+    reader = threading.Thread(target=read_stage, args=(batches, read_queue, stop, errors), daemon=True)
+    writer = threading.Thread(target=write_stage, args=(write_queue, write_func, errors), daemon=True)
+    reader.start()
+    writer.start()
+
+    try:
+        for result in demux_func(get_batches(read_queue)):
+            if errors:
+                break
+            put_batch(write_queue, result, 'demux')
+    finally:
+        stop.set()
+        write_queue.put(end_of_batches)
+        writer.join()
+        reader.join()
+
+    if errors:
+        raise errors[0]
+
+
+def read_stage(batches, read_queue, stop, errors):
+    '''
+    Puts the batches into the read queue (stopping early if the pipeline is stopped)
+    '''
+    try:
+        for batch in batches:
+            if not put_batch(read_queue, batch, 'read', stop):
+                return
+    except Exception as error:
+        errors.append(error)
+    finally:
+        # closes the read file if the pipeline was stopped early
+        if hasattr(batches, 'close'):
+            batches.close()
+        put_batch(read_queue, end_of_batches, 'read', stop)
+        profiler.merge(profiler.collect())
+
+
+def write_stage(write_queue, write_func, errors):
+    '''
+    Writes the results from the write queue until the end of the batches (after an error, the rest
+    are just taken from the queue so the demuxer isn't blocked)
+    '''
+    try:
+        while True:
+            start_time = perf_counter()
+            result = write_queue.get()
+            add_stall('write', perf_counter() - start_time)
+            if result is end_of_batches:
+                return
+            if not errors:
+                write_func(result)
+    except Exception as error:
+        errors.append(error)
+        while write_queue.get() is not end_of_batches:
+            pass
+    finally:
+        profiler.merge(profiler.collect())
+
+
+def get_batches(read_queue):
+    '''
+    Generator that yields the batches from the read queue (for the demuxer)
+    '''
+    while True:
+        start_time = perf_counter()
+        batch = read_queue.get()
+        add_stall('demux', perf_counter() - start_time)
+        if batch is end_of_batches:
+            return
+        yield batch
+
+
+def put_batch(queue, batch, stage, stop=None):
+    '''
+    Puts a batch into a queue, recording the time spent waiting for room as a stall of the stage.
+    :return: False if the pipeline was stopped while waiting
+    '''
+    start_time = perf_counter()
+    try:
+        while True:
+            try:
+                queue.put(batch, timeout=stop_check_interval if stop else None)
+                return True
+            except Full:
+                if stop.is_set():
+                    return False
+    finally:
+        add_stall(stage, perf_counter() - start_time)
@@ -0,0 +1,215 @@
+"""
+Copyright 2019 Andrew Rambaut (a.rambaut@ed.ac.uk)
+https://github.com/rambaut/readucks
+
+This module records the time spent (and the number of calls) in each stage of demuxing when
+Readucks is run with --profile.
+
+Each thread records its own stats which are collected with each chunk of demuxed reads (so they
+can be returned from worker processes) and merged into the report in the main process. When
+profiling isn't enabled the demuxer's functions are left unwrapped and the per-batch timers do
+nothing.
+
+This file is part of Readucks. Readucks is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Readucks is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Readucks. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+
+from . import demuxer
+
+# the demuxer functions that are timed (by name) when profiling
+PROFILED_FUNCTIONS = {
+    'get_score': 'align:get_score',
+    'get_identity': 'align:get_identity',
+    'get_stats': 'align:get_stats',
+    'score_read_end': 'align:score_read_end',
+    'get_all': 'align:get_all',
+    'call_barcode': 'call_barcode'
+}
+
+enabled = False
+
+# this thread's stats that haven't been collected yet
+local_stats = threading.local()
+
+# the merged stats (in the main process)
+report = {
+    'stages': {},
+    'workers': {}
+}
+report_lock = threading.Lock()
+
+
+def enable():
+    '''
+    Turns on profiling in this process by wrapping the demuxer's functions in timers
+    '''
+    global enabled
+
+    if enabled:
+        return
+    enabled = True
+
+    for name, stage in PROFILED_FUNCTIONS.items():
+        setattr(demuxer, name, profiled(stage, getattr(demuxer, name)))
+
+
+def profiled(stage, func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start_time = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            add(stage, perf_counter() - start_time)
+    return wrapper
+
+
+def get_stats():
+    stats = getattr(local_stats, 'stats', None)
+    if stats is None:
+        stats = {'stages': {}, 'workers': {}}
+        local_stats.stats = stats
+    return stats
+
+
+def add(stage, seconds, calls=1):
+    '''
+    Adds the time taken by some calls to a stage
+    '''
+    stages = get_stats()['stages']
+    if stage in stages:
+        stages[stage][0] += calls
+        stages[stage][1] += seconds
+    else:
+        stages[stage] = [calls, seconds]
+
+
+def add_busy(seconds):
+    '''
+    Adds time that the current worker (process and thread) spent demuxing
+    '''
+    worker = str(os.getpid()) + ':' + threading.current_thread().name
+    workers = get_stats()['workers']
+    workers[worker] = workers.get(worker, 0.0) + seconds
+
+
+@contextmanager
+def timer(stage):
+    '''
+    A context manager that times a stage (if profiling is enabled)
+    '''
+    if not enabled:
+        yield
+        return
+
+    start_time = perf_counter()
+    try:
+        yield
+    finally:
+        add(stage, perf_counter() - start_time)
+
+
+def timed_iter(iterator, stage):
+    '''
+    Times how long it takes an iterator (e.g., a parser) to produce each of its items
+    '''
+    if not enabled:
+        return iterator
+    return timed_items(iterator, stage)
+
+
+def timed_items(iterator, stage):
+    iterator = iter(iterator)
+    while True:
+        start_time = perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            add(stage, perf_counter() - start_time)
+        yield item
+
+
+def reset():
+    '''
+    Discards this thread's stats (e.g., those inherited by a forked worker process)
+    '''
+    local_stats.stats = None
+    with report_lock:
+        report['stages'] = {}
+        report['workers'] = {}
+
+
+def collect():
+    '''
+    Returns this thread's stats (resetting them) or None if profiling isn't enabled
+    '''
+    if not enabled:
+        return None
+    stats = get_stats()
+    local_stats.stats = None
+    return stats
+
+
+def merge(stats):
+    '''
+    Merges stats collected in a worker into the report
+    '''
+    if not stats:
+        return
+
+    with report_lock:
+        for stage, (calls, seconds) in stats['stages'].items():
+            if stage in report['stages']:
+                report['stages'][stage][0] += calls
+                report['stages'][stage][1] += seconds
+            else:
+                report['stages'][stage] = [calls, seconds]
+
+        for worker, seconds in stats['workers'].items():
+            report['workers'][worker] = report['workers'].get(worker, 0.0) + seconds
+
+
+def write_report(filename, wall_seconds, info):
+    '''
+    Writes the merged stats as JSON: the calls, total and mean time for each stage and the busy
+    time and utilisation (busy time / wall time) for each worker
+    '''
+    merge(collect())
+
+    with report_lock:
+        stages = {}
+        for stage, (calls, seconds) in sorted(report['stages'].items()):
+            stages[stage] = {
+                'calls': calls,
+                'seconds': seconds,
+                'mean_microseconds': 1e6 * seconds / calls if calls else 0
+            }
+
+        workers = {}
+        for worker, seconds in sorted(report['workers'].items()):
+            workers[worker] = {
+                'busy_seconds': seconds,
+                'utilisation': seconds / wall_seconds if wall_seconds else 0
+            }
+
+    profile = dict(info)
+    profile['wall_seconds'] = wall_seconds
+    profile['stages'] = stages
+    profile['workers'] = workers
+
+    with open(filename, 'wt') as profile_file:
+        json.dump(profile, profile_file, indent=2)
@@ -0,0 +1,387 @@
+"""
+Copyright 2019 Andrew Rambaut (a.rambaut@ed.ac.uk)
+https://github.com/rambaut/readucks
+
+This module contains the functions for opening and reading the input read files (FASTQ or FASTA,
+optionally gzipped).
+
+This file is part of Readucks. Readucks is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Readucks is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Readucks. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import gzip
+import os
+import random
+import shutil
+import struct
+import subprocess
+from collections import namedtuple
+from contextlib import contextmanager
+from io import TextIOWrapper
+from itertools import islice
+from threading import Thread
+
+from Bio import bgzf
+
+from .misc import get_compression_type
+
+# the size of the blocks passed from the decompressing thread to the reader
+decompress_block_size = 1 << 20
+
+# a read: its name (the first word of its title), the fragments of sequence at its start and end
+# (which are all that demuxing needs) and the text of its record (which is carried through demuxing
+# so the read can be binned without being fetched and parsed again)
+Read = namedtuple('Read', ['name', 'start', 'end', 'record'])
+
+
+def get_read_file_type(read_file):
+    '''
+    Returns the type of a read file from its extension: 'fasta' or 'fastq' (the default)
+    '''
+    name = read_file.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+
+    if name.endswith('.fasta'):
+        return 'fasta'
+
+    return 'fastq'
+
+
+def is_read_file(filename):
+    '''
+    Returns true if the filename has one of the read file extensions (optionally gzipped)
+    '''
+    name = filename.lower()
+    return name.endswith('.fastq') or name.endswith('.fastq.gz') or \
+           name.endswith('.fasta') or name.endswith('.fasta.gz')
+
+
+def list_read_files(directory):
+    '''
+    Returns the paths of the read files in a directory (searched recursively), sorted
+    '''
+    return sorted([os.path.join(dir_path, f)
+                   for dir_path, _, filenames in os.walk(directory)
+                   for f in filenames
+                   if is_read_file(f)
+                   ])
+
+
+def is_bgzf(filename):
+    '''
+    Returns true if the file is BGZF (blocked gzip, as written by bgzip) which, unlike plain gzip,
+    can be accessed randomly. BGZF blocks have a 'BC' subfield in the gzip extra field.
+    '''
+    with open(filename, 'rb') as handle:
+        header = handle.read(18)
+
+    return len(header) == 18 and header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
+
+@contextmanager
+def open_read_file(filename):
+    '''
+    Opens a read file for reading as text. Gzipped files are decompressed in the background, by
+    pigz if it is installed or otherwise by a separate thread, so the work of decompressing
+    overlaps with the parsing and demuxing of the reads.
+    '''
+    if get_compression_type(filename) != 'gz':
+        with open(filename, 'rt') as handle:
+            yield handle
+        return
+
+    pigz = shutil.which('pigz')
+    if pigz:
+        process = subprocess.Popen([pigz, '-dc', filename], stdout=subprocess.PIPE)
+        with TextIOWrapper(process.stdout) as handle:
+            try:
+                yield handle
+            finally:
+                # pigz is only stopped if the reader didn't read to the end of its output, otherwise
+                # it must have decompressed the whole file
+                at_end = not handle.read(1)
+                if process.poll() is None and not at_end:
+                    process.kill()
+                if process.wait() and at_end:
+                    raise ValueError(filename + ' could not be decompressed (pigz failed)')
+        return
+
+    read_fd, write_fd = os.pipe()
+    errors = []
+    thread = Thread(target=decompress_to_pipe, args=(filename, write_fd, errors), daemon=True)
+    thread.start()
+    try:
+        with open(read_fd, 'rt') as handle:
+            yield handle
+    finally:
+        thread.join()
+        if errors:
+            raise ValueError(filename + ' could not be decompressed (' + str(errors[0]) + ')')
+
+
+def read_records(handle, file_type, fragment_length):
+    '''
+    Generator that reads the records from a FASTQ or FASTA file sequentially and yields them as Reads
+    with the first and last fragment_length bases of their sequences.
+    '''
+    if file_type == 'fasta':
+        return read_fasta_records(handle, fragment_length)
+    return read_fastq_records(handle, fragment_length)
+
+
+def read_fastq_records(handle, fragment_length):
+    '''
+    Reads FASTQ records of four lines each (as written by the nanopore basecallers).
+    '''
+    for header in handle:
+        if not header.strip():
+            continue
+        sequence = next(handle, '')
+        spacer = next(handle, '')
+        qualities = next(handle, '')
+        if header[0] != '@' or spacer[:1] != '+' or not qualities:
+            raise ValueError('FASTQ record is not formatted correctly: ' + header.strip())
+        if not qualities.endswith('\n'):
+            qualities += '\n'
+
+        bases = sequence.rstrip()
+        yield Read(header[1:].split(None, 1)[0], bases[:fragment_length], bases[-fragment_length:],
+                   header + sequence + spacer + qualities)
+
+
+def read_fasta_records(handle, fragment_length):
+    '''
+    Reads FASTA records, which may have their sequence over several lines.
+    '''
+    lines = []
+    for line in handle:
+        if line[:1] == '>' and lines:
+            yield make_fasta_read(lines, fragment_length)
+            lines = []
+        if not lines and line[:1] != '>':
+            if not line.strip():
+                continue
+            raise ValueError('FASTA record is not formatted correctly: ' + line.strip())
+        lines.append(line)
+
+    if lines:
+        yield make_fasta_read(lines, fragment_length)
+
+
+def make_fasta_read(lines, fragment_length):
+    if not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    sequence = ''.join(line.rstrip() for line in lines[1:])
+    return Read(lines[0][1:].split(None, 1)[0], sequence[:fragment_length], sequence[-fragment_length:],
+                ''.join(lines))
+
+
+def sample_reads(read_files, n_reads, fragment_length, seed=0):
+    '''
+    Returns a random sample of n_reads different Reads from across all the read files (or all their
+    reads, in order, if there are no more than n_reads). If there are no more than twice as many, they
+    are read in order and sampled from. Otherwise they are sampled at positions drawn from all the
+    bytes of the files (see sample_at_positions) so the files don't have to be read through.
+    '''
+    if n_reads < 1:
+        return []
+
+    reads = list(islice(read_files_in_order(read_files, fragment_length), 2 * n_reads + 1))
+    if len(reads) <= n_reads:
+        return reads
+
+    rng = random.Random(seed)
+    if len(reads) <= 2 * n_reads:
+        return [reads[i] for i in sorted(rng.sample(range(len(reads)), n_reads))]
+
+    return sample_at_positions(read_files, n_reads, fragment_length, rng)
+
+
+def read_files_in_order(read_files, fragment_length):
+    for read_file in read_files:
+        with open_read_file(read_file) as handle:
+            yield from read_records(handle, get_read_file_type(read_file), fragment_length)
+
+
+def sample_at_positions(read_files, n_reads, fragment_length, rng):
+    '''
+    Returns n_reads different Reads found at positions drawn uniformly from all the bytes of the read
+    files: the read starting at or after each position is taken. Positions are drawn in rounds until
+    there are n_reads different reads (or a round finds no new one), keeping them in the order drawn.
+    A read's chance of being sampled is in proportion to the length of the record before it (so about
+    the same for every read unless their lengths vary through the files). Plain and BGZF files are
+    read at the positions rather than parsed through but other gzipped files can't be read from a
+    position so the reads for their positions are the next ones from the start of the file.
+    :return: the reads, in the order of the files
+    '''
+    sizes = [os.path.getsize(read_file) for read_file in read_files]
+    total_size = sum(sizes)
+    taken = [0] * len(read_files)
+
+    sampled = {}
+    while len(sampled) < n_reads:
+        draws = [rng.randrange(total_size) for _ in range(2 * (n_reads - len(sampled)))]
+        found = read_at_positions(read_files, sizes, sorted(set(draws)), fragment_length, taken)
+
+        n_sampled = len(sampled)
+        for draw in draws:
+            if draw in found and found[draw][0] not in sampled and len(sampled) < n_reads:
+                sampled[found[draw][0]] = found[draw][1]
+        if len(sampled) == n_sampled:
+            break
+
+    return [sampled[key] for key in sorted(sampled)]
+
+
+def read_at_positions(read_files, sizes, positions, fragment_length, taken):
+    '''
+    Returns the read found at each of the (sorted) positions in all the bytes of the read files, keyed
+    by the position, as a key for the read (the index of its file and its position in the file) and
+    the Read. The reads for positions in a gzipped file that isn't BGZF are the next of its reads
+    after the taken ones (and taken is updated).
+    '''
+    found = {}
+    file_start = 0
+    index = 0
+    for file_index, (read_file, size) in enumerate(zip(read_files, sizes)):
+        file_positions = []
+        while index < len(positions) and positions[index] < file_start + size:
+            file_positions.append(positions[index])
+            index += 1
+
+        if file_positions:
+            file_type = get_read_file_type(read_file)
+            if get_compression_type(read_file) == 'gz' and not is_bgzf(read_file):
+                with open_read_file(read_file) as handle:
+                    records = islice(read_records(handle, file_type, fragment_length),
+                                     taken[file_index], taken[file_index] + len(file_positions))
+                    for position, read in zip(file_positions, records):
+                        found[position] = ((file_index, taken[file_index]), read)
+                        taken[file_index] += 1
+            else:
+                offsets = [position - file_start for position in file_positions]
+                for position, record in zip(file_positions, read_at_offsets(read_file, file_type, offsets,
+                                                                            fragment_length)):
+                    if record:
+                        found[position] = ((file_index, record[0]), record[1])
+
+        file_start += size
+
+    return found
+
+
+def read_at_offsets(read_file, file_type, offsets, fragment_length):
+    '''
+    Returns the Read starting at or after each of the (sorted) offsets in a plain or BGZF read file,
+    with its position in the file (or None if there isn't one). The offsets into a BGZF file are of
+    its compressed bytes (see get_virtual_offsets) and the positions are virtual offsets.
+    '''
+    records = []
+    last_record = None
+    if get_compression_type(read_file) == 'gz':
+        offsets = get_virtual_offsets(read_file, offsets)
+        handle = bgzf.BgzfReader(read_file, 'rb')
+    else:
+        handle = open(read_file, 'rb')
+    with handle:
+        for offset in offsets:
+            position = find_record(handle, file_type, offset) if offset is not None else None
+            if position is None:
+                records.append(None)
+                continue
+
+            # several offsets may fall before the same read
+            if not last_record or last_record[0] != position:
+                lines = (line.decode() for line in handle)
+                read = next(read_records(lines, file_type, fragment_length), None)
+                last_record = (position, read) if read else None
+            records.append(last_record)
+
+    return records
+
+
+def get_virtual_offsets(read_file, offsets):
+    '''
+    Returns the BGZF virtual offsets (which a BgzfReader can seek to) of the (sorted) offsets into the
+    compressed bytes of a BGZF file. Each is as far through the uncompressed data of its block as the
+    offset is through the block (but never at its start, so the virtual offset before it is in the
+    same block), or None for an offset in an empty block. The blocks are found from the sizes in their
+    headers, without decompressing them.
+    '''
+    virtual_offsets = []
+    index = 0
+    block_start = 0
+    with open(read_file, 'rb') as handle:
+        while index < len(offsets):
+            handle.seek(block_start)
+            header = handle.read(18)
+            if len(header) < 18 or header[12:14] != b'BC':
+                break
+            block_size = struct.unpack('<H', header[16:18])[0] + 1
+            # the size of the uncompressed data is the last field of the block
+            handle.seek(block_start + block_size - 4)
+            data_size = struct.unpack('<I', handle.read(4))[0]
+
+            while index < len(offsets) and offsets[index] < block_start + block_size:
+                if data_size > 1:
+                    within = 1 + (offsets[index] - block_start) * (data_size - 1) // block_size
+                    virtual_offsets.append(bgzf.make_virtual_offset(block_start, within))
+                else:
+                    virtual_offsets.append(None)
+                index += 1
+            block_start += block_size
+
+    return virtual_offsets + [None] * (len(offsets) - index)
+
+
+def find_record(handle, file_type, offset):
+    '''
+    Moves a read file (opened in binary, or a BgzfReader with a virtual offset) to the start of the
+    first record at or after the offset. A FASTQ header is told apart from a quality line starting with '@' by its record having a '+' line
+    and a quality line as long as its sequence.
+    :return: the position of the record or None if there isn't one
+    '''
+    # the rest of the line the offset falls in (unless the offset is at the start of a line)
+    handle.seek(max(offset - 1, 0))
+    if offset:
+        handle.readline()
+
+    while True:
+        position = handle.tell()
+        line = handle.readline()
+        if not line:
+            return None
+
+        if file_type == 'fasta':
+            if line[:1] == b'>':
+                handle.seek(position)
+                return position
+        elif line[:1] == b'@':
+            sequence = handle.readline()
+            spacer = handle.readline()
+            qualities = handle.readline()
+            handle.seek(position)
+            if spacer[:1] == b'+' and len(sequence.rstrip()) == len(qualities.rstrip()):
+                return position
+            handle.readline()
+
+
+def decompress_to_pipe(filename, write_fd, errors):
+    '''
+    Decompresses a gzipped file into the write end of a pipe (zlib releases the GIL while it works).
+    Stops quietly if the reader closes the pipe early. Any other error (e.g., from a truncated or
+    corrupt file) is added to errors to be raised by the reader.
+    '''
+    try:
+        with gzip.open(filename, 'rb') as compressed, open(write_fd, 'wb') as pipe:
+            shutil.copyfileobj(compressed, pipe, decompress_block_size)
+    except BrokenPipeError:
+        pass
+    except Exception as error:
+        errors.append(error)
@@ -19,17 +19,36 @@ import os
 import sys
 from collections import defaultdict
 from datetime import datetime
+from time import perf_counter
+from multiprocessing import Pool, Barrier
 from multiprocessing.pool import ThreadPool
 from functools import partial
+from itertools import chain
 
-from Bio import SeqIO
-import parasail
+import numpy as np
 
-from .demuxer import set_alignment_settings, demux_read, best_read_identity, print_result
+from .demuxer import read_fragment_length, init_alignment_worker, get_barcode_panel, get_alignment_plan, \
+    demux_read, collect_alignment_counts, merge_alignment_counts, alignment_counts, score_reads, print_result
 from .barcodes import NATIVE_BARCODES, PCR_BARCODES, RAPID_BARCODES
 from .misc import bold_underline, MyHelpFormatter, output_progress_line
+from .reader import open_read_file, read_records, get_read_file_type, list_read_files, sample_reads
+from .writer import BinWriter, fastq_to_fasta
+from .checkpoint import get_checkpoint_path, new_checkpoint, load_checkpoint, save_checkpoint, truncate_bins, \
+    is_completed
+from .watcher import get_manifest_path, load_manifest, add_to_manifest, watch_input_files
+from .pipeline import run_pipeline, stall_times, default_queue_depth
+from . import profiler
 from .version import __version__
 
+# what a worker does with the chunks of reads it is sent: the demux function for a run's reads and the
+# panel that the sample of reads is checked against (given to each worker process once, see
+# create_worker_pool and set_pool_state, so only the reads are sent with each chunk) and, in a worker
+# process, the barrier that set_pool_state waits at
+worker_state = {'demux_func': None, 'check_panel': None, 'barrier': None}
+
+# the seconds that a worker process waits for the others to be given their state (see set_pool_state)
+worker_state_timeout = 60
+
 
 def main():
     '''
@@ -56,9 +75,26 @@ def main():
         'mode': args.mode,
         'additional_info': args.summary_info,
         'report_alternate_call': args.report_alternate_call,
+        'scoring_scheme': args.scoring_scheme_vals,
+        'prefilter_top': args.prefilter_top,
+        'kmer_size': args.kmer_size,
+        'early_exit': args.mode == 'porechop' and args.early_exit,
+        'prune_after': args.prune_after,
+        'prune_below': args.prune_below / 100.0,
+        'cache_size': int(args.cache_size * 1024 * 1024),
+        'engine': args.engine,
+        'queue_depth': args.queue_depth,
+        'watch': args.watch,
+        'watch_interval': args.watch_interval,
+        'watch_timeout': args.watch_timeout,
+        'resume': args.resume,
+        'profile': args.profile,
         'verbosity': args.verbosity
     }
 
+    if args.profile:
+        profiler.enable()
+
     if args.secondary_threshold:
         settings['secondary_threshold'] = args.secondary_threshold / 100.0
 
@@ -71,9 +107,7 @@ def main():
     # set_alignment_settings( 10,
     #                         1,
     #                         parasail.matrix_create("ACGT", 3, -2))
-    set_alignment_settings( -args.scoring_scheme_vals[2],
-                            -args.scoring_scheme_vals[3],
-                            parasail.matrix_create("ACGT", args.scoring_scheme_vals[0], args.scoring_scheme_vals[1]))
+    init_alignment_worker(args.scoring_scheme_vals)
     output_path = None
     if args.output_dir:
         if os.path.isdir(args.output_dir):
@@ -86,10 +120,17 @@ def main():
         'annotate_files': args.annotate_files,
         'extended_info': args.extended_info,
         'summary_info': args.summary_info,
-        'bin_files': {}
+        'compress_bins': args.compress_bins,
+        'compression_level': args.compression_level,
+        'compress_threads': args.compress_threads,
+        'manifest': get_manifest_path(output_path, args.prefix) if args.watch else None,
+        # when watching, a checkpoint is always kept so a restarted run can carry on from it
+        'checkpoint': get_checkpoint_path(output_path, args.prefix)
+                      if args.checkpoint or args.resume or args.watch else None,
+        'bin_writer': None
     }
 
-    process_files(args.input_path, output, args.limit_barcodes_to, args.check_reads, args.adapter_threshold, settings, args.verbosity, args.threads, args.num_reads_in_batch)
+    process_files(args.input_path, output, args.limit_barcodes_to, args.check_reads, args.adapter_threshold, settings, args.verbosity, args.threads, args.num_reads_in_batch, args.parallel_files)
 
 def get_barcode_list(barcode_set, limit_barcodes_to, verbosity):
     if barcode_set == 'native':
@@ -132,37 +173,40 @@ def filter_barcodes(barcode_set, start_identities, end_identities, adapter_thres
     barcode_list = get_barcode_list(barcode_set, subset_barcodes, verbosity)
     return barcode_list
 
-def run_check_reads(read_files, barcode_list, check_reads, adapter_threshold, settings, batch_size):
-    start_identities = {}
-    end_identities = {}
-
-    for index, read_file in enumerate(read_files):
-        file_type = 'fastq'
-        if read_file.lower().endswith('.fasta'):
-            file_type = 'fasta'
-
-        records = SeqIO.index(read_file, file_type)
-        read_names = list(records.keys())
-        n_reads = min(len(records), check_reads)
-
-        for i in range(0, n_reads, batch_size):
-            reads = [records[r] for r in read_names[i:i + batch_size]]
-            batch_start_identities, batch_end_identities = best_read_identity(reads, barcode_list, settings['barcode_set'])
-
-            for id in barcode_list:
-                if id in start_identities:
-                    start_identities[id] = max(start_identities[id], batch_start_identities[id])
-                else:
-                    start_identities[id] = batch_start_identities[id]
-
-                if id in end_identities:
-                    end_identities[id] = max(end_identities[id], batch_end_identities[id])
-                else:
-                    end_identities[id] = batch_end_identities[id]
+def run_check_reads(read_files, barcode_list, check_reads, adapter_threshold, settings, pool = None, chunk_size = 1):
+    """
+    Aligns a random sample of check_reads reads from across all the files (see sample_reads) against
+    every barcode and keeps the barcodes that some read matches at both ends with an identity over the
+    adapter_threshold. The reads are sent in chunks of chunk_size to the workers of the pool (from
+    create_worker_pool) which are each given the panel of barcodes once.
+    :return: the barcodes kept and the panel scores of the reads checked against them (keyed by read
+    name, with the ends of the read) so the reads don't have to be aligned again when demuxed
+    """
+    queries = [read[:3] for read in sample_reads(read_files, check_reads, read_fragment_length)]
 
-        check_reads = check_reads - n_reads
-        if check_reads <= 0:
-            break
+    panel = get_barcode_panel(barcode_list)
+    set_pool_state(pool, check_panel = panel)
+    with profiler.timer('check_reads'):
+        if pool is None:
+            chunk_results = [check_chunk(queries)]
+        else:
+            chunks = [queries[i:i + chunk_size] for i in range(0, len(queries), chunk_size)]
+            chunk_results = pool.map(check_chunk, chunks)
+
+    panel_scores = []
+    for chunk, stats, counts in chunk_results:
+        panel_scores.extend(chunk)
+        profiler.merge(stats)
+        merge_alignment_counts(counts)
+
+    # the best identities of each barcode (the columns) to the reads (the rows) at each end
+    if panel_scores:
+        best_start = np.array([scores[1] for scores in panel_scores]).max(axis=0)
+        best_end = np.array([scores[3] for scores in panel_scores]).max(axis=0)
+    else:
+        best_start = best_end = np.zeros(len(panel['ids']))
+    start_identities = dict(zip(panel['ids'], best_start))
+    end_identities = dict(zip(panel['ids'], best_end))
 
     if settings['verbosity'] > 0:
         print("Best start and end identities")
@@ -170,21 +214,63 @@ def run_check_reads(read_files, barcode_list, check_reads, adapter_threshold, se
             print("%s\tStart: %f\tEnd: %f" %(id, start_identities[id], end_identities[id]), flush=True)
 
     barcode_list = filter_barcodes(settings['barcode_set'], start_identities, end_identities, adapter_threshold, settings['verbosity'])
-    return barcode_list
+
+    # the scores of the barcodes kept, in the order of their panel
+    columns = [panel['ids'].index(barcode_id) for barcode_id in barcode_list]
+    checked_reads = {}
+    for query, scores in zip(queries, panel_scores):
+        checked_reads[query[0]] = (query[1], query[2], tuple(values[columns] for values in scores))
+
+    return barcode_list, checked_reads
+
+def check_chunk(queries):
+    """
+    Scores a chunk of reads against the worker's check panel (for run_check_reads) and returns the panel
+    scores along with the worker's profiling stats and counts of alignments.
+    """
+    return score_reads(queries, worker_state['check_panel']), profiler.collect(), collect_alignment_counts()
 
 
 
-def process_files(input_path, output, limit_barcodes_to, check_reads, adapter_threshold, settings, verbosity, threads, batch_size):
+def process_files(input_path, output, limit_barcodes_to, check_reads, adapter_threshold, settings, verbosity, threads, batch_size,
+                  parallel_files = 1):
     """
     Core function to process one or more input files and create the required output files.
 
     Iterates through the reads in one or more input files and bins or filters them into the
-    output files as required.
+    output files as required. Up to parallel_files input files are processed concurrently
+    (sharing the worker pool and the bin files).
     """
 
     start_time = datetime.now()
 
-    read_files = get_input_files(input_path)
+    # when resuming (or restarting a watch), the reads binned since the checkpoint are removed and the
+    # completed files skipped
+    checkpoint = None
+    if settings['resume'] or settings['watch']:
+        checkpoint = load_checkpoint(output['checkpoint'])
+        if checkpoint:
+            truncate_bins(checkpoint)
+            if verbosity > 0:
+                print("Resuming from the checkpoint with " + str(len(checkpoint['files'])) +
+                      " read {} completed".format('files' if len(checkpoint['files']) != 1 else 'file'), flush=True)
+        elif settings['resume']:
+            print("No checkpoint found in the output directory so starting from the beginning", flush=True)
+
+    file_groups = iter(())
+    if settings['watch']:
+        if verbosity > 0:
+            print("Watching " + input_path + " for read files (Ctrl-C to stop)", flush=True)
+        # a file in the manifest but not the checkpoint may not have all its reads in the bin files
+        processed = set(checkpoint['files']) if checkpoint else load_manifest(output['manifest'])
+        file_groups = watch_input_files(input_path, processed, settings['watch_interval'], settings['watch_timeout'])
+        all_files = read_files = next(file_groups, [])
+        if not read_files:
+            print("No new read files found in " + input_path)
+            return
+    else:
+        all_files = get_input_files(input_path)
+        read_files = [read_file for read_file in all_files if not checkpoint or not is_completed(checkpoint, read_file)]
 
     if verbosity > 0:
         print(bold_underline('\n' + str(len(read_files)) + " read {} found".format('files' if len(read_files) > 1 else 'file')), flush=True)
@@ -194,42 +280,173 @@ def process_files(input_path, output, limit_barcodes_to, check_reads, adapter_th
             print(read_file, flush=True)
 
     barcode_counts = defaultdict(int)
-
-    barcode_list = get_barcode_list(settings['barcode_set'], limit_barcodes_to, verbosity)
-
-    output['file_type'] = get_output_file_type(read_files)
-
-    if check_reads:
-        print("Use first %i reads to subset barcodes" %check_reads)
-        barcode_list = run_check_reads(read_files, barcode_list, check_reads, adapter_threshold, settings, batch_size)
+    if checkpoint:
+        barcode_counts.update(checkpoint['barcode_counts'])
+
+    output['file_type'] = get_output_file_type(all_files)
+    if output['bin_barcodes']:
+        # the bin files are shared by all the input files
+        output['bin_writer'] = BinWriter(output['path'], output['prefix'], output['file_type'],
+                                         output['compress_bins'], output['compression_level'],
+                                         output['compress_threads'], checkpoint['bins'] if checkpoint else None)
+
+    # hand each worker a few chunks of every batch to balance the load without
+    # paying the dispatch cost for every read
+    chunk_size = max(1, batch_size // (threads * 4))
+
+    # a single worker pool is used for the check and all the batches in all the files
+    pool_start_time = datetime.now()
+    pool = create_worker_pool(settings['engine'], threads, settings['scoring_scheme'], settings['profile'])
+    pool_startup_time = datetime.now() - pool_start_time
+
+    # the panel scores of the reads aligned by the check, which are used when they are demuxed
+    checked_reads = None
+    try:
+        if checkpoint:
+            # the barcodes are those the run being resumed looked for
+            barcode_list = get_barcode_list(settings['barcode_set'], checkpoint['barcodes'], verbosity)
+        else:
+            barcode_list = get_barcode_list(settings['barcode_set'], limit_barcodes_to, verbosity)
+
+            if check_reads:
+                print("Use a sample of %i reads to subset barcodes" %check_reads)
+                barcode_list, checked_reads = run_check_reads(all_files, barcode_list, check_reads,
+                                                              adapter_threshold, settings, pool, chunk_size)
+
+            if output['checkpoint']:
+                checkpoint = new_checkpoint(barcode_list)
+
+        # each worker is given the demux function (with the panel, plan and settings) once so only the
+        # reads are sent with each chunk
+        plan = get_alignment_plan(settings['single_barcode'], settings['mode'], settings['additional_info'],
+                                  settings['report_alternate_call'], output['extended_info'], verbosity)
+        state_start_time = datetime.now()
+        set_pool_state(pool, demux_func = get_demux_func(barcode_list, settings, plan))
+        pool_startup_time += datetime.now() - state_start_time
+    except BaseException:
+        if pool:
+            pool.terminate()
+            pool.join()
+        raise
 
     if verbosity > 0:
         print(bold_underline("\nProcessing files"), flush=True)
         output_progress_line(0, len(read_files))
 
-    for index, read_file in enumerate(read_files):
-
-        process_read_file(read_file, output, barcode_list, settings, barcode_counts, verbosity, threads, batch_size)
-
-        if verbosity > 0:
-            output_progress_line(index, len(read_files))
-
-    if verbosity > 0:
-        output_progress_line(len(read_files), len(read_files))
+    file_func = partial(count_read_file,
+                        output = output,
+                        settings = settings,
+                        verbosity = verbosity,
+                        pool = pool,
+                        batch_size = batch_size,
+                        chunk_size = chunk_size,
+                        checked_reads = checked_reads)
+
+    file_pool = None
+    n_files = 0
+    try:
+        if parallel_files > 1 and (len(read_files) > 1 or settings['watch']):
+            # the file threads just read, dispatch to the worker pool and write so they are cheap
+            file_pool = ThreadPool(parallel_files if settings['watch'] else min(parallel_files, len(read_files)))
+
+        # when watching, the files that are found later are processed as they appear
+        for group_index, read_files in enumerate(chain([read_files], file_groups)):
+            if group_index > 0:
+                read_files = get_writable_files(read_files, output['file_type'])
+                if verbosity > 0:
+                    print(bold_underline('\n' + str(len(read_files)) + " new read {} found".format(
+                        'files' if len(read_files) != 1 else 'file')), flush=True)
+
+            # checkpoints are made between rounds of files so no file is part way through
+            if output['checkpoint']:
+                rounds = [read_files[i:i + parallel_files] for i in range(0, len(read_files), parallel_files)]
+            else:
+                rounds = [read_files]
+
+            index = 0
+            for round_files in rounds:
+                if file_pool and len(round_files) > 1:
+                    file_results = file_pool.imap_unordered(file_func, round_files)
+                else:
+                    file_results = map(file_func, round_files)
+
+                for read_file, file_counts in file_results:
+                    for barcode_id in file_counts:
+                        barcode_counts[barcode_id] += file_counts[barcode_id]
+                    n_files += 1
+                    index += 1
+
+                    if output['manifest']:
+                        # the file's reads are written out of the bin buffers before it is listed
+                        if output['bin_writer']:
+                            output['bin_writer'].checkpoint()
+                        add_to_manifest(output['manifest'], read_file)
+
+                    if verbosity > 0:
+                        output_progress_line(index, len(read_files))
+
+                if output['checkpoint']:
+                    save_checkpoint(output['checkpoint'], checkpoint, round_files, barcode_counts,
+                                    output['bin_writer'].checkpoint() if output['bin_writer'] else {})
+    finally:
+        if file_pool:
+            file_pool.close()
+            file_pool.join()
+
+        pool_stop_time = datetime.now()
+        if pool:
+            pool.close()
+            pool.join()
+        pool_shutdown_time = datetime.now() - pool_stop_time
+
+        # the buffered reads are written out even if the run is stopped
+        bin_filenames = output['bin_writer'].close() if output['bin_writer'] else []
+
+    if verbosity > 0 and settings['watch']:
+        print("\n" + str(n_files) + " read {} processed".format('files' if n_files != 1 else 'file'))
 
     time = datetime.now() - start_time
 
+    if settings['profile']:
+        profiler.write_report(settings['profile'], time.total_seconds(), {
+            'read_files': n_files,
+            'reads': sum(barcode_counts.values()),
+            'engine': settings['engine'],
+            'threads': threads,
+            'batch_size': batch_size,
+            'parallel_files': parallel_files,
+            'pool_startup_seconds': pool_startup_time.total_seconds(),
+            'pool_shutdown_seconds': pool_shutdown_time.total_seconds(),
+            'alignments': alignment_counts['aligned'],
+            'alignments_skipped': alignment_counts['skipped'],
+            'cache_hits': alignment_counts['cache_hits'],
+            'cache_misses': alignment_counts['cache_misses'],
+            'queue_depth': settings['queue_depth'],
+            'stall_seconds': dict(stall_times)
+        })
+
     if verbosity > 0:
         print("\n\nTime taken: " + str(time.total_seconds()) + " secs")
+        if pool:
+            workers = 'processes' if settings['engine'] == 'process' else 'threads'
+            print("Worker pool (" + str(threads) + " " + workers + ") startup: " +
+                  str(pool_startup_time.total_seconds()) + " secs, shutdown: " +
+                  str(pool_shutdown_time.total_seconds()) + " secs")
+        print("Alignments: " + str(alignment_counts['aligned']) + ", skipped: " + str(alignment_counts['skipped']))
+        if settings['cache_size']:
+            lookups = alignment_counts['cache_hits'] + alignment_counts['cache_misses']
+            print("Fragment cache hits: " + str(alignment_counts['cache_hits']) + " of " + str(lookups) + " read ends (" +
+                  "{:.1f}".format(100 * alignment_counts['cache_hits'] / lookups if lookups else 0) + "%)")
+        print("Stalled: reading " + "{:.2f}".format(stall_times['read']) + " secs, demuxing " +
+              "{:.2f}".format(stall_times['demux']) + " secs, writing " + "{:.2f}".format(stall_times['write']) +
+              " secs")
 
         if output['bin_barcodes']:
             if verbosity > 0:
                 print(bold_underline("\nBinned reads by barcode"), flush=True)
 
-        for f in output['bin_files'].values():
-            if verbosity > 0:
-                print(f.name, flush=True)
-            f.close()
+        for filename in bin_filenames:
+            print(filename, flush=True)
 
     if verbosity > 0:
         print(bold_underline('\nBarcodes called:'), flush=True)
@@ -243,6 +460,64 @@ def process_files(input_path, output, limit_barcodes_to, check_reads, adapter_th
             print(barcode_name + ": " + str(barcode_counts[barcode_name]), flush=True)
 
 
+def create_worker_pool(engine, threads, scoring_scheme, profile = None, demux_func = None, check_panel = None):
+    """
+    Creates the pool of workers used to demux (or check) the reads: either a pool of threads or, for
+    the 'process' engine, a pool of processes that each set up their own alignment settings and are
+    given the demux function or check panel once, when they start or by set_pool_state (threads share
+    this process's).
+    :return: the pool or None if only a single thread is to be used
+    """
+    if engine == 'process' and threads > 1:
+        barrier = Barrier(threads)
+        pool = Pool(threads, initializer=init_worker_process, initargs=(scoring_scheme, profile, demux_func,
+                                                                        check_panel, barrier))
+        pool.worker_barrier = barrier
+        return pool
+
+    set_worker_state(demux_func, check_panel)
+    if threads == 1:
+        return None
+
+    return ThreadPool(threads)
+
+def init_worker_process(scoring_scheme, profile, demux_func = None, check_panel = None, barrier = None):
+    """
+    Sets up a worker process: its alignment settings, what it does with the reads it is sent and (if
+    required) profiling.
+    """
+    init_alignment_worker(scoring_scheme)
+    set_worker_state(demux_func, check_panel)
+    worker_state['barrier'] = barrier
+    if profile:
+        profiler.reset()
+        profiler.enable()
+
+def set_pool_state(pool, demux_func = None, check_panel = None):
+    """
+    Changes the demux function and check panel of the workers of a pool from create_worker_pool (e.g.,
+    once the check has chosen the barcodes). Each worker process is sent them once, in a task that
+    waits for all the others to have theirs so no worker can take two.
+    """
+    barrier = getattr(pool, 'worker_barrier', None)
+    if barrier is None:
+        # threads share this process's state
+        set_worker_state(demux_func, check_panel)
+        return
+
+    pool.map(set_process_state, [(demux_func, check_panel)] * barrier.parties, chunksize = 1)
+
+def set_process_state(state):
+    set_worker_state(*state)
+    worker_state['barrier'].wait(worker_state_timeout)
+
+def set_worker_state(demux_func, check_panel):
+    """
+    Sets the demux function and check panel used by demux_chunk and check_chunk in this process.
+    """
+    worker_state['demux_func'] = demux_func
+    worker_state['check_panel'] = check_panel
+
 def get_input_files(input_path):
     '''
     Takes a path to a single file or a directory and returns a list of file paths to be processed.
@@ -258,12 +533,7 @@ def get_input_files(input_path):
 
     # If the input is a directory, search it recursively for fastq files.
     elif os.path.isdir(input_path):
-        input_files = sorted([os.path.join(dir_path, f)
-                              for dir_path, _, filenames in os.walk(input_path)
-                              for f in filenames
-                              if f.lower().endswith('.fastq') or #f.lower().endswith('.fastq.gz') or
-                              f.lower().endswith('.fasta') # or f.lower().endswith('.fasta.gz')
-                              ])
+        input_files = list_read_files(input_path)
         if not input_files:
             sys.exit('Error: could not find FASTQ/FASTA files in ' + input_path)
 
@@ -273,6 +543,21 @@ def get_input_files(input_path):
     return input_files
 
 
+def get_writable_files(read_files, file_type):
+    """
+    Returns the read files that can be binned as the output file type (FASTQ reads can be binned
+    as FASTA but not the reverse), warning about any that can't (e.g., when watching a directory)
+    """
+    writable = []
+    for read_file in read_files:
+        if file_type == 'fastq' and get_read_file_type(read_file) == 'fasta':
+            print("Warning: skipping " + read_file + " as FASTA reads can't be added to the FASTQ outputs",
+                  file=sys.stderr, flush=True)
+        else:
+            writable.append(read_file)
+    return writable
+
+
 def get_output_file_type(read_files):
     """
     returns the output file type. This will be 'fastq' unless one of the
@@ -283,50 +568,152 @@ def get_output_file_type(read_files):
     file_type = 'fastq'
 
     for read_file in read_files:
-        if read_file.lower().endswith('.fasta'):
+        if get_read_file_type(read_file) == 'fasta':
             file_type = 'fasta'
 
     return file_type
 
 
-def process_read_file(read_file, output, barcodes, settings, barcode_counts, verbosity, threads = 1, batch_size = 200):
+def count_read_file(read_file, output, settings, verbosity, pool = None, batch_size = 200, chunk_size = 1,
+                    checked_reads = None):
+    """
+    Processes a single input file, keeping its own barcode counts so that several files can be
+    processed at once.
+    :return: the file and its barcode counts
+    """
+    barcode_counts = defaultdict(int)
+    process_read_file(read_file, output, settings, barcode_counts, verbosity, pool, batch_size, chunk_size,
+                      checked_reads)
+    return read_file, barcode_counts
+
+def process_read_file(read_file, output, settings, barcode_counts, verbosity, pool = None, batch_size = 200,
+                      chunk_size = 1, checked_reads = None):
     """
     Iterates through the reads in an input files and bins or filters them into the
-    output files as required.
-    """
-    demux_func = partial(demux_read,
-                         barcodes = barcodes,
-                         barcode_set = settings['barcode_set'],
-                         single_barcode = settings['single_barcode'],
-                         threshold = settings['threshold'],
-                         secondary_threshold = settings['secondary_threshold'],
-                         score_diff = settings['score_diff'],
-                         mode = settings['mode'],
-                         additional_info = settings['additional_info'],
-                         report_alternate_call = settings['report_alternate_call'],
-                         verbosity = settings['verbosity'])
+    output files as required. If a worker pool is given then the reads in each batch are
+    demuxed in parallel using it (otherwise in the current thread, with the demux function set by
+    create_worker_pool). Reads in checked_reads (those
+    aligned by run_check_reads) are demuxed with their panel scores rather than aligned again.
+
+    Reads are streamed through the demuxer in batches by a pipeline (reading, demuxing and writing
+    at the same time) so no more than about queue_depth batches of reads (and their results) wait
+    between the stages.
+    """
+    file_type = get_read_file_type(read_file)
 
-    file_type = 'fastq'
-    if read_file.lower().endswith('.fasta'):
-        file_type = 'fasta'
+    annotation_file, summary_file = open_annotation_files(read_file, output, settings)
 
-    records = SeqIO.index(read_file, file_type)
-    read_names = list(records.keys())
-    n_reads = len(records)
+    totals = {'reads': 0, 'results': 0}
+    run_pipeline(profiler.timed_iter(read_batches(read_file, file_type, batch_size), 'read_parse'),
+                 partial(demux_batches, pool = pool, chunk_size = chunk_size, checked_reads = checked_reads),
+                 partial(write_batch, output = output, settings = settings, barcode_counts = barcode_counts,
+                         annotation_file = annotation_file, summary_file = summary_file, file_type = file_type,
+                         totals = totals, verbosity = verbosity),
+                 settings['queue_depth'])
+    n_reads = totals['reads']
+    n_results = totals['results']
 
-    results = []
-    for i in range(0, n_reads, batch_size):
-        reads = [records[r] for r in read_names[i:i + batch_size]]
+    print("Reads length: ", n_reads, " and results length: ", n_results)
 
-        if threads == 1: # if single threading then don't use a thread pool
-            for read in reads:
-                results.append(demux_func(read))
-        else:
-            with ThreadPool(threads) as pool:
-                results.extend(pool.map(demux_func, reads))
+    if annotation_file:
+        annotation_file.close()
 
-    print("Reads length: ", n_reads, " and results length: ", len(results))
+    if summary_file:
+        summary_file.close()
 
+    profiler.merge(profiler.collect())
+
+def get_demux_func(barcodes, settings, plan):
+    """
+    Returns the demux_read function with all the arguments except the read filled in from the settings
+    (and the barcodes made into a panel, once, so each read end is scored against all of them at once)
+    and the plan of the alignments it needs to do.
+    """
+    return partial(demux_read,
+                   panel = get_barcode_panel(barcodes, settings['prefilter_top'], settings['kmer_size'],
+                                             settings['early_exit'], settings['prune_after'], settings['prune_below'],
+                                             settings['cache_size']),
+                   plan = plan,
+                   barcode_set = settings['barcode_set'],
+                   single_barcode = settings['single_barcode'],
+                   threshold = settings['threshold'],
+                   secondary_threshold = settings['secondary_threshold'],
+                   score_diff = settings['score_diff'],
+                   mode = settings['mode'],
+                   report_alternate_call = settings['report_alternate_call'],
+                   verbosity = settings['verbosity'])
+
+def read_batches(read_file, file_type, batch_size):
+    """
+    Generator that reads the records sequentially from a file and yields them in lists of
+    at most batch_size reads.
+    """
+    with open_read_file(read_file) as handle:
+        reads = []
+        for read in read_records(handle, file_type, read_fragment_length):
+            reads.append(read)
+            if len(reads) == batch_size:
+                yield reads
+                reads = []
+
+        if reads:
+            yield reads
+
+def demux_batches(batches, pool = None, chunk_size = 1, checked_reads = None):
+    """
+    Generator that demuxes each batch of reads as it arrives and yields the batch with its
+    list of results (in the same order as the reads). The reads are sent to the pool's workers
+    in chunks of chunk_size.
+    """
+    for reads in batches:
+        # the demuxer only needs the name and the ends of each read, not its whole record
+        queries = [get_query(read, checked_reads) for read in reads]
+        with profiler.timer('demux_batch'):
+            if pool is None: # if single threading then don't use a thread pool
+                chunk_results = [demux_chunk(queries)]
+            else:
+                chunks = [queries[i:i + chunk_size] for i in range(0, len(queries), chunk_size)]
+                chunk_results = pool.map(demux_chunk, chunks)
+
+        results = []
+        for chunk, stats, counts in chunk_results:
+            results.extend(chunk)
+            profiler.merge(stats)
+            merge_alignment_counts(counts)
+
+        yield reads, results
+
+def get_query(read, checked_reads):
+    """
+    Returns what the demuxer needs of a read: its name and the ends of its sequence, followed by its
+    panel scores if it was aligned by run_check_reads (each is only used once and only if the read's
+    ends are the same, in case another read has the same name).
+    """
+    if checked_reads:
+        checked = checked_reads.pop(read.name, None)
+        if checked and checked[0] == read.start and checked[1] == read.end:
+            return read[:3] + (checked[2],)
+    return read[:3]
+
+def demux_chunk(queries):
+    """
+    Demuxes a chunk of reads in a worker (with its demux function) and returns the results along with
+    the worker's profiling stats and counts of alignments (which can't otherwise be seen from the main
+    process when the workers are processes).
+    """
+    demux_func = worker_state['demux_func']
+    start_time = perf_counter()
+    results = [demux_func(query) for query in queries]
+    if profiler.enabled:
+        profiler.add_busy(perf_counter() - start_time)
+    return results, profiler.collect(), collect_alignment_counts()
+
+def open_annotation_files(read_file, output, settings):
+    """
+    Opens the annotation (and summary) CSV files for an input file, if required, and writes
+    their header lines.
+    :return: a tuple of the annotation file and the summary file (either may be None)
+    """
     annotation_file = None
     summary_file = None
     if output['annotate_files'] or output['summary_info']:
@@ -368,62 +755,72 @@ def process_read_file(read_file, output, barcodes, settings, barcode_counts, ver
                   'secondary_end_matches', 'secondary_end_length',
                   file=summary_file, sep=',')
 
-    # threadpool map function maintains the same order as the input data
-    for result in results:
-        barcode_counts[result['call']] += 1
-
-        if annotation_file:
-            fields = [result['name'], result['call']]
-            if settings["report_alternate_call"]:
-                fields.append(result['alt_call'])
-            if output['extended_info']:
-               fields.extend([result['primary']['id'], result['primary']['start'], result['primary']['score'],
-                      result['primary']['identity'], result['primary']['matches'], result['primary']['length'],
-                      result['secondary']['id'], result['secondary']['start'], result['secondary']['score'],
-                      result['secondary']['identity'], result['secondary']['matches'], result['secondary']['length']])
-            print(','.join(fields), file=annotation_file)
+    return annotation_file, summary_file
 
-        if output['summary_info']:
-            print(result['name'], result['call'],
-                  result['primary']['id'], result['primary']['start'], result['primary']['start_score'],
-                  result['primary']['start_identity'], result['primary']['start_matches'],
-                  result['primary']['start_length'], result['primary']['end_score'], result['primary']['end_identity'],
-                  result['primary']['end_matches'], result['primary']['end_length'],
-                  result['secondary']['id'], result['secondary']['start'], result['secondary']['start_score'],
-                  result['secondary']['start_identity'], result['secondary']['start_matches'],
-                  result['secondary']['start_length'], result['secondary']['end_score'],
-                  result['secondary']['end_identity'], result['secondary']['end_matches'],
-                  result['secondary']['end_length'],
-                  file=summary_file, sep=',')
+def write_batch(batch, output, settings, barcode_counts, annotation_file, summary_file, file_type, totals,
+                verbosity):
+    """
+    Writes out a batch of demuxed reads (in the writer thread of the pipeline) and adds them to the totals.
+    """
+    reads, results = batch
+    totals['reads'] += len(reads)
+    totals['results'] += len(results)
 
-        if output['bin_barcodes']:
-            read = records[result['name']]
-            bin_read(read, result, output)
+    # the map functions maintain the same order as the input data
+    with profiler.timer('csv_write'):
+        for read, result in zip(reads, results):
+            write_result(read, result, output, settings, barcode_counts, annotation_file, summary_file, verbosity)
+
+    if output['bin_barcodes']:
+        with profiler.timer('bin_write'):
+            bin_reads(reads, results, file_type, output)
 
-        if verbosity > 1:
-            print_result(result)
+def write_result(read, result, output, settings, barcode_counts, annotation_file, summary_file, verbosity):
+    """
+    Counts a demuxed read and writes it to the annotation, summary and bin files as required.
+    """
+    barcode_counts[result.call] += 1
 
     if annotation_file:
-        annotation_file.close()
+        fields = [result.name, result.call]
+        if settings["report_alternate_call"]:
+            fields.append(result.alt_call)
+        if output['extended_info']:
+            primary = result.primary
+            secondary = result.secondary
+            fields.extend([primary.id, primary.is_start, primary.score, primary.identity, primary.matches,
+                           primary.length,
+                           secondary.id, secondary.is_start, secondary.score, secondary.identity, secondary.matches,
+                           secondary.length])
+        print(*fields, file=annotation_file, sep=',')
 
     if summary_file:
-        summary_file.close()
-
-    records.close()
-
-def bin_read(read, result, output):
+        primary = result.primary
+        secondary = result.secondary
+        print(result.name, result.call,
+              primary.id, primary.is_start, primary.start.score, primary.start.identity, primary.start.matches,
+              primary.start.length, primary.end.score, primary.end.identity, primary.end.matches,
+              primary.end.length,
+              secondary.id, secondary.is_start, secondary.start.score, secondary.start.identity,
+              secondary.start.matches, secondary.start.length, secondary.end.score, secondary.end.identity,
+              secondary.end.matches, secondary.end.length,
+              file=summary_file, sep=',')
+
+    if verbosity > 1:
+        print_result(result, settings['mode'] == 'lenient')
+
+def bin_reads(reads, results, file_type, output):
     """
-    Bins a read into the appropriate file (creating it if necessary).
+    Bins a batch of reads into the files for their barcode calls, copying the text of their
+    records (converted to FASTA if some of the input files are FASTA). The batch is written in
+    one piece even if other input files are being processed at the same time.
     """
+    if file_type == output['file_type']:
+        records = [read.record for read in reads]
+    else:
+        records = [fastq_to_fasta(read.record) for read in reads]
 
-    if result['call'] not in output['bin_files']:
-        filename = output['path'] if output['path'] else ""
-        filename += output['prefix'] if output['prefix'] else ""
-
-        filename += result['call'] + "." + output['file_type']
-        output['bin_files'][result['call']] = open(filename, "wt")
-
-    SeqIO.write(read, output['bin_files'][result['call']], output['file_type'])
+    output['bin_writer'].write_batch([result.call for result in results], records)
 
 def get_arguments():
     '''
@@ -435,7 +832,7 @@ def get_arguments():
     main_group = parser.add_argument_group('Main options')
     main_group.add_argument('-i', '--input', dest='input_path', required=True,
                             help='FASTQ of input reads or a directory which will be '
-                                 'recursively searched for FASTQ files (required).')
+                                 'recursively searched for FASTQ files, which may be gzipped (required).')
     main_group.add_argument('-o', '--output_dir',
                             help='Output directory (default: working directory)')
     main_group.add_argument('-b', '--bin_barcodes', action='store_true',
@@ -448,18 +845,53 @@ def get_arguments():
                             help='Writes extended information about barcode calls. ')
     main_group.add_argument('-s', '--summary_info', action='store_true',
                             help='Writes another file with information about barcode calls. ')
+    main_group.add_argument('--compress_bins', action='store_true',
+                            help='Gzip the binned read files')
+    main_group.add_argument('--compression_level', type=int, default=6, choices=range(1, 10), metavar='[1-9]',
+                            help='The gzip compression level for the binned read files')
+    main_group.add_argument('--compress_threads', type=int, default=1,
+                            help='The number of background threads used to compress the binned read files '
+                                 '(0 to compress as the reads are binned)')
     main_group.add_argument('-m', '--mode', default='porechop',
                             help='Demuxing mode, one of ["stringent","lenient", "porechop"].')
     main_group.add_argument('-p', '--prefix',
                             help='Optional prefix to file names')
     main_group.add_argument('-t', '--threads', type=int, default=2,
                             help='The number of threads to use (1 to turn off multithreading)')
+    main_group.add_argument('--engine', default='thread', choices=['thread', 'process'],
+                            help='Run the demuxing workers as threads or as separate processes (which '
+                                 'avoids contention for the Python interpreter lock)')
     main_group.add_argument('-n', '--num_reads_in_batch', type=int, default=200,
                             help='The number of reads to process (and hold in memory) at a time')
+    main_group.add_argument('--parallel_files', type=int, default=1,
+                            help='The number of input files to process at the same time')
+    main_group.add_argument('--queue_depth', type=int, default=default_queue_depth,
+                            help='The number of batches of reads that can wait between reading, demuxing '
+                                 'and writing (which bounds the memory used)')
+    main_group.add_argument('--watch', action='store_true',
+                            help='Keep watching the input directory and demux new read files as they are '
+                                 'completed (adding to the existing outputs and skipping the files listed in '
+                                 'the manifest of processed files)')
+    main_group.add_argument('--watch_interval', type=float, default=10,
+                            help='How often (in seconds) to look for new read files when watching')
+    main_group.add_argument('--watch_timeout', type=float, default=0,
+                            help='Stop watching when no new read file has appeared for this many seconds '
+                                 '(0 to watch until interrupted)')
+    main_group.add_argument('--checkpoint', action='store_true',
+                            help='Keep a checkpoint of the run in the output directory (updated as each input '
+                                 'file is completed) so it can be resumed')
+    main_group.add_argument('--resume', action='store_true',
+                            help='Resume a run from its checkpoint: skip the input files already completed, cut '
+                                 'the reads binned since off the bin files and carry on (keeping the checkpoint)')
     main_group.add_argument('--check_reads', type=int, default=1000,
-                            help='Number of barcodes to classify before filtering barcode set')
+                            help='Number of reads (sampled from across all the input files) to classify '
+                                 'before filtering barcode set. Gzipped files that aren\'t BGZF (bgzip) can\'t '
+                                 'be read from a random position so their share of the reads is taken from '
+                                 'their start')
     main_group.add_argument('--adapter_threshold', type=int, default=90,
                             help='Identity required for a barcode to be included after filtering')
+    main_group.add_argument('--profile', metavar='PROFILE_FILE',
+                            help='Time each stage of the demuxing and write a report (JSON) to this file')
     main_group.add_argument('-v', '--verbosity', type=int, default=1,
                             help='Level of output information: 0 = none, 1 = some, 2 = lots')
 
@@ -490,6 +922,26 @@ def get_arguments():
     barcode_search_group.add_argument('--scoring_scheme', type=str, default='3,-6,-5,-2',
                                       help='Comma-delimited string of alignment scores: match, '
                                            'mismatch, gap open, gap extend')
+    barcode_search_group.add_argument('--prefilter_top', type=int, default=0,
+                                      help='Only align the barcodes sharing the most k-mers with each end of a read '
+                                           '(this many and any tied with them) unless none of them is a clear match '
+                                           '(0 to align all the barcodes)')
+    barcode_search_group.add_argument('--kmer_size', type=int, default=5,
+                                      help='The length of the k-mers used by --prefilter_top (and to bound the '
+                                           'identities of barcodes when exiting early)')
+    barcode_search_group.add_argument('--early_exit', action='store_true',
+                                      help='In porechop mode, skip aligning barcodes whose shared k-mers show they '
+                                           'can\'t come within score_diff of the best barcode found so far')
+    barcode_search_group.add_argument('--prune_after', type=int, default=0,
+                                      help='Once this many reads have been demuxed, only align the barcodes that no '
+                                           'read has been called as when none of the others is a clear match (0 to '
+                                           'not prune)')
+    barcode_search_group.add_argument('--prune_below', type=float, default=0,
+                                      help='With --prune_after, also prune the barcodes that at most this percent of '
+                                           'the reads have been called as')
+    barcode_search_group.add_argument('--cache_size', type=float, default=0,
+                                      help='Cache the scores of read end fragments seen before, using up to this many '
+                                           'MB in each process (0 to not cache)')
 
     help_args = parser.add_argument_group('Help')
     help_args.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS,
@@ -499,6 +951,32 @@ def get_arguments():
 
     args = parser.parse_args()
 
+    if args.parallel_files < 1:
+        sys.exit('Error: --parallel_files must be at least 1')
+
+    if args.queue_depth < 1:
+        sys.exit('Error: --queue_depth must be at least 1')
+
+    if args.watch and not os.path.isdir(args.input_path):
+        sys.exit('Error: --watch needs a directory to watch as the input')
+
+    # the bins written into the watched directory would be taken as new read files
+    if args.watch and os.path.commonpath([os.path.abspath(args.output_dir or '.'),
+                                          os.path.abspath(args.input_path)]) == os.path.abspath(args.input_path):
+        sys.exit('Error: with --watch the output directory must not be inside the input directory')
+
+    if args.watch_interval <= 0 or args.watch_timeout < 0:
+        sys.exit('Error: --watch_interval must be positive and --watch_timeout must not be negative')
+
+    if args.prefilter_top < 0 or args.kmer_size < 1:
+        sys.exit('Error: --prefilter_top must not be negative and --kmer_size must be at least 1')
+
+    if args.prune_after < 0 or not 0 <= args.prune_below < 100:
+        sys.exit('Error: --prune_after must not be negative and --prune_below must be from 0 to less than 100')
+
+    if args.cache_size < 0:
+        sys.exit('Error: --cache_size must not be negative')
+
     if (args.native_barcodes and args.pcr_barcodes) or (args.native_barcodes and args.rapid_barcodes) or (args.pcr_barcodes and args.rapid_barcodes):
         sys.exit(
             'Error: only one of the following options may be used: --native_barcodes, --pcr_barcodes or --rapid_barcodes')
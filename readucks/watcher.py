@@ -0,0 +1,85 @@
+"""
+Copyright 2019 Andrew Rambaut (a.rambaut@ed.ac.uk)
+https://github.com/rambaut/readucks
+
+This module watches an input directory for new read files (e.g., as they are written by MinKNOW
+during a sequencing run) when Readucks is run with --watch, and keeps the manifest of the files
+that have been processed so a restarted run doesn't process them again.
+
+This file is part of Readucks. Readucks is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Readucks is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Readucks. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+
+from .reader import list_read_files
+
+manifest_filename = 'readucks_manifest.txt'
+
+
+def get_manifest_path(output_path, prefix):
+    '''
+    Returns the path of the manifest in the output directory
+    '''
+    return (output_path if output_path else "") + (prefix if prefix else "") + manifest_filename
+
+
+def load_manifest(filename):
+    '''
+    Returns the set of read files (as absolute paths) listed in a manifest (empty if there isn't one)
+    '''
+    if not os.path.exists(filename):
+        return set()
+
+    with open(filename, 'rt') as manifest_file:
+        return set(line.rstrip('\n') for line in manifest_file if line.strip())
+
+
+def add_to_manifest(filename, read_file):
+    '''
+    Adds a read file that has been completely processed to the manifest
+    '''
+    with open(filename, 'at') as manifest_file:
+        print(os.path.abspath(read_file), file=manifest_file, flush=True)
+
+
+def watch_input_files(input_path, processed, interval, timeout=0):
+    '''
+    Generator that watches a directory and yields lists of the read files that have appeared in it
+    (and aren't in the set of processed files) once they are complete: their size hasn't changed
+    since the last look or they haven't been modified for the interval. Stops when no new file has
+    appeared for timeout seconds (if given) or when interrupted (Ctrl-C) while waiting.
+    '''
+    sizes = {}
+    last_new_time = time.time()
+    try:
+        while True:
+            now = time.time()
+            complete = []
+            current = {}
+            for read_file in list_read_files(input_path):
+                if os.path.abspath(read_file) in processed:
+                    continue
+                stat = os.stat(read_file)
+                if sizes.get(read_file) == stat.st_size or stat.st_mtime <= now - interval:
+                    complete.append(read_file)
+                    processed.add(os.path.abspath(read_file))
+                else:
+                    current[read_file] = stat.st_size
+            sizes = current
+
+            if complete:
+                yield complete
+                last_new_time = time.time()
+            elif timeout and now - last_new_time >= timeout:
+                return
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        return
@@ -0,0 +1,173 @@
+"""
+Copyright 2019 Andrew Rambaut (a.rambaut@ed.ac.uk)
+https://github.com/rambaut/readucks
+
+This module contains the writer used to bin reads into one file per barcode.
+
+This file is part of Readucks. Readucks is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Readucks is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Readucks. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import gzip
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+# the number of characters of reads to hold for each barcode before writing them out
+bin_buffer_size = 1 << 18
+
+fasta_line_length = 60
+
+
+def format_fastq(title, sequence, qualities):
+    '''
+    Returns the text of a FASTQ record
+    '''
+    return '@' + title + '\n' + sequence + '\n+\n' + qualities + '\n'
+
+
+def format_fasta(title, sequence):
+    '''
+    Returns the text of a FASTA record (with the sequence wrapped as Biopython writes it)
+    '''
+    lines = [sequence[i:i + fasta_line_length] + '\n' for i in range(0, len(sequence), fasta_line_length)]
+    return '>' + title + '\n' + ''.join(lines)
+
+
+def fastq_to_fasta(record):
+    '''
+    Returns the text of a FASTQ record as a FASTA record
+    '''
+    lines = record.split('\n', 2)
+    return format_fasta(lines[0][1:], lines[1])
+
+
+class BinWriter:
+    '''
+    Writes reads into a file for each barcode call (created when the first read for it arrives).
+    The records are buffered for each barcode and written out in blocks. If compressed, each block
+    is written as a separate gzip member (concatenated members make a valid gzip file) which lets
+    the blocks be compressed by background threads. Each barcode is always handled by the same
+    thread so its blocks are written in order. The reads are added to the existing bin files in
+    resume_files (e.g., those kept from the checkpoint of a run being resumed), any other bin file
+    is written from the start.
+    '''
+
+    def __init__(self, path, prefix, file_type, compress=False, compression_level=6, compress_threads=1,
+                 resume_files=None):
+        self.path = path if path else ""
+        self.prefix = prefix if prefix else ""
+        self.file_type = file_type
+        self.compress = compress
+        self.compression_level = compression_level
+        self.resume_files = set(resume_files) if resume_files else set()
+
+        self.files = {}
+        self.buffers = {}
+        self.buffer_sizes = {}
+        self.bin_executors = {}
+        self.pending = {}
+
+        # reads from several input files may be binned at the same time
+        self.lock = Lock()
+
+        self.executors = [ThreadPoolExecutor(1) for _ in range(compress_threads)] if compress else []
+
+    def get_filename(self, call):
+        filename = self.path + self.prefix + call + "." + self.file_type
+        if self.compress:
+            filename += ".gz"
+        return filename
+
+    def write_batch(self, calls, records):
+        '''
+        Bins a batch of records (the text of each one) by their barcode calls. The whole batch is
+        added while holding the lock so it can't be interleaved with another batch.
+        '''
+        with self.lock:
+            for call, record in zip(calls, records):
+                self.write(call, record)
+
+    def write(self, call, record):
+        if call not in self.files:
+            if self.executors:
+                self.bin_executors[call] = self.executors[len(self.files) % len(self.executors)]
+            filename = self.get_filename(call)
+            append = os.path.abspath(filename) in self.resume_files
+            self.files[call] = open(filename, "ab" if append else "wb")
+            self.buffers[call] = []
+            self.buffer_sizes[call] = 0
+
+        self.buffers[call].append(record)
+        self.buffer_sizes[call] += len(record)
+
+        if self.buffer_sizes[call] >= bin_buffer_size:
+            self.flush(call)
+
+    def flush(self, call):
+        if not self.buffers[call]:
+            return
+
+        data = ''.join(self.buffers[call]).encode()
+        self.buffers[call] = []
+        self.buffer_sizes[call] = 0
+
+        if self.executors:
+            # only one block per barcode is queued at a time which bounds the memory used (and
+            # raises any error from writing the previous one)
+            if call in self.pending:
+                self.pending[call].result()
+            self.pending[call] = self.bin_executors[call].submit(self.write_block, self.files[call], data)
+        else:
+            self.write_block(self.files[call], data)
+
+    def write_block(self, bin_file, data):
+        if self.compress:
+            data = gzip.compress(data, self.compression_level, mtime=0)
+        bin_file.write(data)
+
+    def checkpoint(self):
+        '''
+        Writes out all the buffered reads (waiting for any being compressed) so the bin files hold
+        all the reads binned so far.
+        :return: the length of each bin file, keyed by its absolute path
+        '''
+        with self.lock:
+            for call in self.files:
+                self.flush(call)
+
+            for future in self.pending.values():
+                future.result()
+            self.pending = {}
+
+            offsets = {}
+            for bin_file in self.files.values():
+                bin_file.flush()
+                offsets[os.path.abspath(bin_file.name)] = bin_file.tell()
+
+            return offsets
+
+    def close(self):
+        '''
+        Writes out all the buffered reads and closes the bin files.
+        :return: the names of the bin files
+        '''
+        with self.lock:
+            for call in self.files:
+                self.flush(call)
+
+            for future in self.pending.values():
+                future.result()
+
+            for executor in self.executors:
+                executor.shutdown(wait=True)
+
+            for bin_file in self.files.values():
+                bin_file.close()
+
+            return [bin_file.name for bin_file in self.files.values()]
@@ -103,7 +103,8 @@ setup(name='readucks',
       author_email='a.rambaut@ed.ac.uk',
       license='GPL',
       packages=['readucks'],
-      entry_points={"console_scripts": ['readucks = readucks.readucks:main']},
+      entry_points={"console_scripts": ['readucks = readucks.readucks:main',
+                                          'readucks-benchmark = readucks.benchmark:main']},
       zip_safe=False,
       cmdclass={'build': Build,
                 'install': Install,
@@ -0,0 +1,83 @@
+"""
+Copyright 2019 Andrew Rambaut (a.rambaut@ed.ac.uk)
+https://github.com/rambaut/readucks
+
+Tests of cutting the bin files back to a checkpoint and of adding to them when resuming.
+
+This file is part of Readucks. Readucks is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Readucks is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Readucks. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import gzip
+import os
+
+import pytest
+
+from readucks.checkpoint import new_checkpoint, truncate_bins
+from readucks.writer import BinWriter
+
+
+def test_truncate_bins(tmp_path):
+    bin_file = tmp_path / 'BC01.fastq'
+    bin_file.write_text('@read0\nACGT\n+\nIIII\n@read1\nAC')
+    checkpoint = new_checkpoint(['BC01'])
+    checkpoint['bins'] = {str(bin_file): 19}
+
+    truncate_bins(checkpoint)
+
+    assert bin_file.read_text() == '@read0\nACGT\n+\nIIII\n'
+
+
+def test_truncate_bins_shorter(tmp_path):
+    bin_file = tmp_path / 'BC01.fastq'
+    bin_file.write_text('@read0\n')
+    checkpoint = new_checkpoint(['BC01'])
+    checkpoint['bins'] = {str(bin_file): 20}
+
+    with pytest.raises(SystemExit):
+        truncate_bins(checkpoint)
+
+    checkpoint['bins'] = {str(tmp_path / 'BC02.fastq'): 0}
+    with pytest.raises(SystemExit):
+        truncate_bins(checkpoint)
+
+
+def read_bin(filename, compress):
+    with (gzip.open(filename, 'rt') if compress else open(filename, 'rt')) as bin_file:
+        return bin_file.read()
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_bin_writer_resume(tmp_path, compress):
+    path = str(tmp_path) + os.sep
+    records = ['@read' + str(i) + '\nACGT\n+\nIIII\n' for i in range(6)]
+
+    writer = BinWriter(path, None, 'fastq', compress=compress, compress_threads=2)
+    writer.write_batch(['BC01', 'BC02'], records[0:2])
+    offsets = writer.checkpoint()
+    assert offsets == {os.path.abspath(filename): os.path.getsize(filename)
+                       for filename in [writer.get_filename('BC01'), writer.get_filename('BC02')]}
+    # reads binned after the checkpoint are cut off when resuming
+    writer.write_batch(['BC01', 'BC02'], records[2:4])
+    filenames = writer.close()
+    assert read_bin(filenames[0], compress) == records[0] + records[2]
+
+    checkpoint = new_checkpoint(['BC01', 'BC02'])
+    checkpoint['bins'] = offsets
+    truncate_bins(checkpoint)
+
+    # only the bins kept from the checkpoint are added to, any other is written from the start
+    bc01 = os.path.abspath(writer.get_filename('BC01'))
+    writer = BinWriter(path, None, 'fastq', compress=compress, resume_files=[bc01])
+    writer.write_batch(['BC01', 'BC02'], records[4:6])
+    offsets = writer.checkpoint()
+    writer.close()
+
+    assert read_bin(writer.get_filename('BC01'), compress) == records[0] + records[4]
+    assert read_bin(writer.get_filename('BC02'), compress) == records[5]
+    assert offsets[bc01] == os.path.getsize(bc01)
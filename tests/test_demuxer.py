@@ -0,0 +1,144 @@
+"""
+Copyright 2019 Andrew Rambaut (a.rambaut@ed.ac.uk)
+https://github.com/rambaut/readucks
+
+Tests that the ways of saving alignments (exiting early, caching read end fragments and the plan of
+the alignments each read needs) don't change the barcodes called, and that the bounds used to exit
+early are never below the identities of the alignments.
+
+This file is part of Readucks. Readucks is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Readucks is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Readucks. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import random
+
+import pytest
+
+from readucks import demuxer
+from readucks.benchmark import generate_reads, random_sequence, add_errors
+from readucks.demuxer import read_fragment_length, init_alignment_worker, get_barcode_panel, get_alignment_plan, \
+    find_shared_kmers, get_identity_bounds, score_panel, collect_alignment_counts
+from readucks.reader import open_read_file, read_records
+from readucks.readucks import get_barcode_list, get_demux_func
+
+# the default scoring scheme: match, mismatch, gap open, gap extend
+scoring_scheme = [3, -6, -5, -2]
+
+# a plan that does every alignment, as demux_read did before it had a plan
+full_plan = {'secondary': True, 'secondary_second': True, 'both_ends': True, 'traces': False}
+
+
+@pytest.fixture(scope='module')
+def reads(tmp_path_factory):
+    read_file = str(tmp_path_factory.mktemp('reads') / 'reads.fastq')
+    generate_reads(read_file, 100, 'pcr', 0.12, 300, 0.1, 3)
+    with open_read_file(read_file) as handle:
+        return [read[:3] for read in read_records(handle, 'fastq', read_fragment_length)]
+
+
+@pytest.fixture(autouse=True)
+def alignment_settings():
+    init_alignment_worker(scoring_scheme)
+
+
+def demux_calls(reads, mode='porechop', single_barcode=True, report_alternate_call=False, additional_info=False,
+                plan=None, **options):
+    '''
+    Demuxes the reads (in this process) and returns the call and alternate call of each
+    '''
+    settings = {
+        'barcode_set': 'pcr',
+        'single_barcode': single_barcode,
+        'threshold': 0.75,
+        'secondary_threshold': 0.65 if mode != 'porechop' else None,
+        'score_diff': 0.05,
+        'mode': mode,
+        'additional_info': additional_info,
+        'report_alternate_call': report_alternate_call,
+        'prefilter_top': 0,
+        'kmer_size': 5,
+        'early_exit': False,
+        'prune_after': 0,
+        'prune_below': 0,
+        'cache_size': 0,
+        'verbosity': 0
+    }
+    settings.update(options)
+    if plan is None:
+        plan = get_alignment_plan(single_barcode, mode, additional_info, report_alternate_call, False, 0)
+
+    # the calls made so far (for exiting early), the cache and the counts are kept by the process
+    collect_alignment_counts()
+    demuxer.observed_calls.clear()
+    demuxer.fragment_cache['entries'].clear()
+    demuxer.fragment_cache['bytes'] = 0
+
+    demux_func = get_demux_func(get_barcode_list('pcr', None, 0), settings, plan)
+    return [(result.call, result.alt_call) for result in map(demux_func, reads)]
+
+
+def test_early_exit(reads):
+    calls = demux_calls(reads)
+
+    assert demux_calls(reads, early_exit=True) == calls
+    assert collect_alignment_counts()['skipped'] > 0
+    assert demux_calls(reads, early_exit=True, kmer_size=3) == calls
+
+
+def test_cache(reads):
+    # each read end twice so half of the fragments are found in the cache
+    reads = reads + [('copy_' + read[0],) + read[1:] for read in reads]
+    calls = demux_calls(reads)
+
+    assert demux_calls(reads, cache_size=1024 * 1024) == calls
+    assert collect_alignment_counts()['cache_hits'] == len(reads)
+    assert demux_calls(reads, cache_size=1024 * 1024, early_exit=True) == calls
+    # a cache too small for all the fragments
+    assert demux_calls(reads, cache_size=20000) == calls
+
+
+@pytest.mark.parametrize('mode', ['porechop', 'lenient', 'stringent'])
+@pytest.mark.parametrize('single_barcode', [True, False])
+@pytest.mark.parametrize('report_alternate_call', [False, True])
+@pytest.mark.parametrize('additional_info', [False, True])
+def test_alignment_plan(reads, mode, single_barcode, report_alternate_call, additional_info):
+    calls = demux_calls(reads, mode, single_barcode, report_alternate_call, additional_info)
+
+    assert calls == demux_calls(reads, mode, single_barcode, report_alternate_call, additional_info, full_plan)
+
+
+def get_read_ends(barcodes, rng):
+    '''
+    Returns random read ends and read ends with each barcode (with errors) at their start, some
+    hanging off it, and in them
+    '''
+    ends = [random_sequence(rng, read_fragment_length) for _ in range(20)]
+    for barcode in barcodes:
+        overhang = rng.randint(1, len(barcode) // 2)
+        ends.append(add_errors(rng, barcode, 0.1) + random_sequence(rng, read_fragment_length))
+        ends.append(add_errors(rng, barcode[overhang:], 0.1) + random_sequence(rng, read_fragment_length))
+        ends.append(barcode[overhang:] + random_sequence(rng, read_fragment_length))
+        ends.append(random_sequence(rng, 30) + add_errors(rng, barcode, 0.15) + random_sequence(rng, 30))
+    return [end[:read_fragment_length] for end in ends]
+
+
+@pytest.mark.parametrize('barcode_set', ['pcr', 'native'])
+@pytest.mark.parametrize('kmer_size', [3, 5])
+def test_identity_bounds(barcode_set, kmer_size):
+    panel = get_barcode_panel(get_barcode_list(barcode_set, None, 0), kmer_size=kmer_size, early_exit=True)
+    rng = random.Random(kmer_size)
+
+    for end in ['start', 'end']:
+        references = panel[end]
+        shape = (len(references), panel[end + '_width'] - kmer_size + 1)
+        for query in get_read_ends([reference for reference in references if reference], rng):
+            found = find_shared_kmers(query, panel[end + '_kmers'], kmer_size, shape)
+            bounds = get_identity_bounds(query, found, panel, end)
+            _, identities = score_panel(query, references, True)
+
+            assert (bounds >= identities - 1e-9).all()
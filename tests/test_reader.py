@@ -0,0 +1,171 @@
+"""
+Copyright 2019 Andrew Rambaut (a.rambaut@ed.ac.uk)
+https://github.com/rambaut/readucks
+
+Tests of the reading of FASTQ and FASTA records and of the sampling of reads from read files.
+
+This file is part of Readucks. Readucks is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. Readucks is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with Readucks. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+
+import gzip
+import io
+
+import pytest
+from Bio import bgzf
+
+from readucks.reader import read_records, find_record, read_at_offsets, sample_reads
+
+
+def test_fastq_quality_line_starting_with_at():
+    '''
+    A quality line starting with '@' is read as the qualities of its record, not as a header
+    '''
+    text = '@read1 runid=1\nACGTACGT\n+\n@@@@IIII\n@read2\nTTTT\n+\n@III\n'
+    reads = list(read_records(io.StringIO(text), 'fastq', 3))
+
+    assert [read.name for read in reads] == ['read1', 'read2']
+    assert reads[0].start == 'ACG' and reads[0].end == 'CGT'
+    assert reads[0].record == '@read1 runid=1\nACGTACGT\n+\n@@@@IIII\n'
+    assert reads[1].record == '@read2\nTTTT\n+\n@III\n'
+
+
+def test_fastq_without_trailing_newline():
+    text = '@read1\nACGT\n+\nIIII\n@read2\nGGCC\n+\nIIII'
+    reads = list(read_records(io.StringIO(text), 'fastq', 100))
+
+    assert [read.name for read in reads] == ['read1', 'read2']
+    assert reads[1].start == reads[1].end == 'GGCC'
+    assert reads[1].record == '@read2\nGGCC\n+\nIIII\n'
+
+
+def test_fastq_truncated_record():
+    with pytest.raises(ValueError):
+        list(read_records(io.StringIO('@read1\nACGT\n+\nIIII\n@read2\nACGT\n'), 'fastq', 100))
+
+
+def test_fasta_multi_line():
+    text = '>read1 description\nACGT\nACGT\nAC\n>read2\nGGGG\n\n>read3\nTTTT'
+    reads = list(read_records(io.StringIO(text), 'fasta', 5))
+
+    assert [read.name for read in reads] == ['read1', 'read2', 'read3']
+    assert reads[0].start == 'ACGTA' and reads[0].end == 'CGTAC'
+    assert reads[0].record == '>read1 description\nACGT\nACGT\nAC\n'
+    assert reads[1].start == 'GGGG'
+    assert reads[2].record == '>read3\nTTTT\n'
+
+
+def write_reads(n_reads):
+    '''
+    Returns the text of n_reads FASTQ records of different lengths, some with qualities starting
+    with '@'
+    '''
+    return ''.join('@read' + str(i) + '\n' + 'ACGT' * (1 + i % 5) + '\n+\n' + '@III' * (1 + i % 5) + '\n'
+                   for i in range(n_reads))
+
+
+def test_find_record(tmp_path):
+    text = write_reads(10)
+    read_file = tmp_path / 'reads.fastq'
+    read_file.write_text(text)
+    second = text.index('@read1')
+
+    with open(str(read_file), 'rb') as handle:
+        assert find_record(handle, 'fastq', 0) == 0
+        assert find_record(handle, 'fastq', 1) == second
+        assert handle.readline() == b'@read1\n'
+        # an offset in a quality line starting with '@' finds the next record
+        assert find_record(handle, 'fastq', text.index('@III')) == second
+        assert find_record(handle, 'fastq', len(text) - 2) is None
+
+
+def test_find_record_fasta(tmp_path):
+    text = '>read0\nACGT\nACGT\n>read1\nGG\n'
+    read_file = tmp_path / 'reads.fasta'
+    read_file.write_text(text)
+
+    with open(str(read_file), 'rb') as handle:
+        assert find_record(handle, 'fasta', 3) == text.index('>read1')
+
+
+def test_read_at_offsets(tmp_path):
+    text = write_reads(10)
+    read_file = tmp_path / 'reads.fastq'
+    read_file.write_text(text)
+    offsets = [0, 1, 2, text.index('@read5') + 1, len(text) - 1]
+
+    records = read_at_offsets(str(read_file), 'fastq', offsets, 100)
+
+    # offsets before the same read give the same read
+    assert [record[1].name if record else None for record in records] == ['read0', 'read1', 'read1', 'read6', None]
+    assert records[1] is records[2]
+    assert records[3][0] == text.index('@read6')
+    assert records[3][1].record == '@read6\nACGTACGT\n+\n@III@III\n'
+
+
+@pytest.mark.parametrize('compression', ['plain', 'bgzf', 'gzip'])
+def test_sample_reads(tmp_path, compression):
+    n_reads = 2000
+    text = write_reads(n_reads)
+    if compression == 'plain':
+        read_file = tmp_path / 'reads.fastq'
+        read_file.write_text(text)
+    elif compression == 'bgzf':
+        read_file = tmp_path / 'reads.fastq.gz'
+        with bgzf.BgzfWriter(str(read_file), 'wb') as handle:
+            handle.write(text.encode())
+    else:
+        read_file = tmp_path / 'reads.fastq.gz'
+        read_file.write_bytes(gzip.compress(text.encode()))
+
+    reads = sample_reads([str(read_file)], 200, 100, seed=1)
+    indices = [int(read.name[4:]) for read in reads]
+
+    assert len(set(indices)) == len(indices) == 200
+    assert all(read.record == '@read' + str(i) + '\n' + 'ACGT' * (1 + i % 5) + '\n+\n' + '@III' * (1 + i % 5) + '\n'
+               for read, i in zip(reads, indices))
+    if compression == 'gzip':
+        # plain gzip files can only be read from the start
+        assert max(indices) < 2 * 200
+    else:
+        assert min(indices) < n_reads // 10 and max(indices) > n_reads * 9 // 10
+
+
+@pytest.mark.parametrize('n_reads', [1500, 4500])
+def test_sample_reads_all(tmp_path, n_reads):
+    read_file = tmp_path / 'reads.fastq'
+    read_file.write_text(write_reads(1500))
+
+    # asking for at least as many reads as there are gives all of them, in order
+    reads = sample_reads([str(read_file)], n_reads, 100)
+
+    assert [read.name for read in reads] == ['read' + str(i) for i in range(1500)]
+
+
+def test_sample_reads_most(tmp_path):
+    read_file = tmp_path / 'reads.fastq'
+    read_file.write_text(write_reads(1500))
+
+    reads = sample_reads([str(read_file)], 1000, 100)
+    indices = [int(read.name[4:]) for read in reads]
+
+    assert len(set(indices)) == 1000
+    assert indices == sorted(indices)
+
+
+def test_sample_reads_across_files(tmp_path):
+    read_files = []
+    for i in range(3):
+        read_file = tmp_path / ('reads' + str(i) + '.fastq')
+        read_file.write_text(write_reads(200).replace('@read', '@file' + str(i) + '_'))
+        read_files.append(str(read_file))
+
+    reads = sample_reads(read_files, 60, 100)
+
+    assert {read.name.split('_')[0] for read in reads} == {'file0', 'file1', 'file2'}
+    assert sample_reads([], 10, 100) == []